@@ -0,0 +1,287 @@
+from dataloader import DataLoader
+from models import model_factory
+from options import parse_args
+
+import torch
+import copy
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+
+
+ALL_BENCHMARKS = ['generate_task', 'models',
+                  'outer_loop', 'eval', 'adapt', 'pretrain_epoch']
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timeit(fn, repeats, warmup=1):
+    '''
+    time fn
+
+    Args:
+        fn : function without arguments
+        repeats : the number of timed calls
+        warmup : the number of untimed calls before timing
+    return:
+        result : median, mean, min and max milliseconds per call
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        synchronize()
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'median_ms': float(np.median(times)),
+        'mean_ms': float(np.mean(times)),
+        'min_ms': float(np.min(times)),
+        'max_ms': float(np.max(times)),
+        'repeats': repeats,
+    }
+
+
+def benchmark_args(args):
+    '''
+        copy of args that does not touch real logs, checkpoints or pretrained weights
+    '''
+    args = copy.copy(args)
+    tmp_dir = tempfile.mkdtemp(prefix='melo_benchmark_')
+    args.log_dir = os.path.join(tmp_dir, 'log')
+    args.pretrain_log_dir = os.path.join(tmp_dir, 'log_pretrained')
+    args.metrics_backend = 'none'
+    args.async_checkpoint = False
+    args.use_task_store = False
+    args.load_pretrained = False
+    args.load_pretrained_embedding = False
+    args.save_pretrained = False
+    return args
+
+
+def device():
+    if torch.cuda.is_available():
+        return torch.cuda.current_device()
+    return torch.device('cpu')
+
+
+def bench_generate_task(args, dataloader):
+    return timeit(lambda: dataloader.generate_task(
+        mode="train", batch_size=args.batch_size, normalized=args.normalize_loss, use_label=args.use_label),
+        args.benchmark_repeats, args.benchmark_warmup)
+
+
+def bench_model(args, dataloader, model_name):
+    '''
+        functional forward (params dict, as in the inner loop) and backward of one support set
+    '''
+    args = copy.copy(args)
+    args.model = model_name
+    args.device = device()
+    model = model_factory(args).to(args.device)
+    model.train()
+    params = {name: param for name, param in model.named_parameters()
+              if param.requires_grad}
+
+    support, _, _ = dataloader.generate_task(
+        mode="train", batch_size=1, normalized=args.normalize_loss, use_label=args.use_label)[0]
+    _, _, _, product_history_ratings, target_rating = support
+    inputs = tuple(x.to(args.device) for x in support[:4])
+    gt = torch.cat((product_history_ratings, target_rating),
+                   dim=1).to(args.device)
+    mask = (gt != 0)
+
+    def step():
+        outputs = model(inputs, params=params)
+        loss = ((outputs*mask - gt*mask/5.0) ** 2).sum()/mask.sum()
+        torch.autograd.grad(loss, list(params.values()), allow_unused=True)
+
+    return timeit(step, args.benchmark_repeats, args.benchmark_warmup)
+
+
+def bench_outer_loop(args, maml):
+    task_batch = maml.dataloader.generate_task(
+        mode="train", batch_size=args.batch_size, normalized=args.normalize_loss, use_label=args.use_label)
+    return timeit(lambda: maml._outer_loop(task_batch, train=True),
+                  args.benchmark_repeats, args.benchmark_warmup)
+
+
+def bench_eval(args, maml):
+    task_batches = list(maml.iter_eval_tasks("valid", args.val_size))
+
+    def evaluate():
+        maml.reset_rating_info()
+        maml.evaluate(task_batches)
+
+    return timeit(evaluate, args.benchmark_long_repeats, 1)
+
+
+def bench_adapt(args, maml):
+    '''
+        adaptation of a task batch one task at a time and with one adapt_batch call
+    '''
+    task_batch = maml.dataloader.generate_task(
+        mode="train", batch_size=args.batch_size, normalized=args.normalize_loss, use_label=args.use_label)
+
+    def sequential():
+        for support, _, task_info in task_batch:
+            maml.adapt(support, task_info)
+
+    def batch():
+        maml.adapt_batch([(support, task_info)
+                          for support, _, task_info in task_batch])
+
+    return (timeit(sequential, args.benchmark_repeats, args.benchmark_warmup),
+            timeit(batch, args.benchmark_repeats, args.benchmark_warmup))
+
+
+def bench_pretrain_epoch(args):
+    from train_original import Basic
+
+    basic = Basic(args)
+    return timeit(lambda: basic.epoch_step(basic.pretraining_train_loader),
+                  args.benchmark_long_repeats, 1)
+
+
+def run_benchmarks(args):
+    '''
+        run the benchmarks selected by args.benchmarks
+        return:
+            results : benchmark name -> timing
+            dataset : size of the benchmarked dataset
+    '''
+    from main import MAML
+
+    args = benchmark_args(args)
+    benchmarks = args.benchmarks.split(',')
+    for name in benchmarks:
+        if name not in ALL_BENCHMARKS:
+            raise ValueError(f'Unknown benchmark: {name}')
+    results = {}
+
+    def report(name, result):
+        results[name] = result
+        print(f"{name:<32}{result['median_ms']:>12.2f} ms "
+              f"(min {result['min_ms']:.2f} | max {result['max_ms']:.2f})")
+
+    dataloader = DataLoader(copy.copy(args), pretraining=False)
+    args.num_users = dataloader.num_users
+    args.num_items = dataloader.num_items
+    dataset = {
+        'num_users': dataloader.num_users,
+        'num_items': dataloader.num_items,
+        'num_interactions': dataloader.total_data_num,
+    }
+
+    if 'generate_task' in benchmarks:
+        report('generate_task', bench_generate_task(args, dataloader))
+    if 'models' in benchmarks:
+        for model_name in args.benchmark_models.split(','):
+            report(f'model/{model_name}',
+                   bench_model(args, dataloader, model_name))
+    if 'outer_loop' in benchmarks or 'eval' in benchmarks or 'adapt' in benchmarks:
+        maml = MAML(copy.copy(args))
+        if 'outer_loop' in benchmarks:
+            report('outer_loop', bench_outer_loop(args, maml))
+        if 'eval' in benchmarks:
+            report('eval', bench_eval(args, maml))
+        if 'adapt' in benchmarks:
+            sequential, batch = bench_adapt(args, maml)
+            report('adapt/sequential', sequential)
+            report('adapt/batch', batch)
+        maml.checkpoint_writer.close()
+    if 'pretrain_epoch' in benchmarks:
+        report('pretrain_epoch', bench_pretrain_epoch(copy.copy(args)))
+    return results, dataset
+
+
+def peak_memory():
+    '''
+        peak resident memory of this process and peak allocated cuda memory in MB
+    '''
+    # ru_maxrss is in kilobytes on linux
+    memory = {'peak_rss_mb': resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if torch.cuda.is_available():
+        memory['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+    return memory
+
+
+def environment():
+    env = {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'num_threads': torch.get_num_threads(),
+    }
+    if torch.cuda.is_available():
+        env['cuda_device'] = torch.cuda.get_device_name()
+    return env
+
+
+def compare(results, baseline, tolerance):
+    '''
+    compare median times with a baseline result file
+
+    Args:
+        results : benchmark name -> timing
+        baseline : content of a previous benchmark json file
+        tolerance : allowed relative slowdown (0.1 : 10%)
+    return:
+        regressions : names of benchmarks slower than the baseline by more than tolerance
+    '''
+    regressions = []
+    print(f"{'benchmark':<32}{'baseline ms':>14}{'current ms':>14}{'ratio':>9}")
+    for name, result in results.items():
+        if name not in baseline['results']:
+            print(f"{name:<32}{'-':>14}{result['median_ms']:>14.2f}{'-':>9}")
+            continue
+        base_ms = baseline['results'][name]['median_ms']
+        ratio = result['median_ms'] / max(base_ms, 1e-12)
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  <- regression'
+        print(f"{name:<32}{base_ms:>14.2f}{result['median_ms']:>14.2f}{ratio:>9.2f}{flag}")
+    return regressions
+
+
+def main(args):
+    if args.mode != 'synthetic':
+        print(f'Benchmarking on {args.mode} ({args.data_path})')
+    results, dataset = run_benchmarks(args)
+
+    output = {
+        'config': vars(args),
+        'environment': environment(),
+        'dataset': dataset,
+        'memory': peak_memory(),
+        'results': results,
+    }
+    with open(args.benchmark_output, 'w') as f:
+        json.dump(output, f, indent=1, default=str)
+    print('Results saved to', args.benchmark_output)
+
+    if args.benchmark_baseline is not None:
+        with open(args.benchmark_baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.benchmark_tolerance)
+        if regressions:
+            print(f"Performance regressions: {', '.join(regressions)}")
+            sys.exit(1)
+        print('No performance regression.')
+
+
+if __name__ == '__main__':
+    main(parse_args())
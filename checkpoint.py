@@ -0,0 +1,324 @@
+import copy
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+# checkpoint entries stored as memory-mappable tensor blobs, everything else
+# (optimizers, schedulers, training state) goes to training.pt
+TENSOR_COMPONENTS = ['meta_model', 'loss_model',
+                     'loss_weight_model', 'lstm_model', 'learning_rate']
+# small json entry stored in meta.json, readable without loading the checkpoint
+CONFIG_COMPONENT = 'model_config'
+BLOB_ALIGNMENT = 64
+# a checkpoint being replaced is moved to {path}.old until the new one is in place
+OLD_SUFFIX = '.old'
+
+
+def save_tensor_blob(path, state_dict):
+    '''
+        write a flat dict of tensors as one raw blob (path.bin) and an index (path.json)
+    '''
+    index = OrderedDict()
+    offset = 0
+    with open(path + '.bin', 'wb') as f:
+        for name, tensor in state_dict.items():
+            array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+            index[name] = {'dtype': array.dtype.str,
+                           'shape': list(array.shape), 'offset': offset}
+            f.write(array.tobytes())
+            offset += array.nbytes
+            # keep every tensor aligned
+            padding = -offset % BLOB_ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+    with open(path + '.json', 'w') as f:
+        json.dump(index, f)
+
+
+def load_tensor_blob(path):
+    '''
+        memory map a blob written by save_tensor_blob
+        tensors share memory with the file (copy-on-write), pages are read lazily
+    '''
+    with open(path + '.json') as f:
+        index = json.load(f, object_pairs_hook=OrderedDict)
+    state_dict = OrderedDict()
+    if os.path.getsize(path + '.bin') == 0:
+        blob = np.zeros(0, dtype=np.uint8)
+    else:
+        blob = np.memmap(path + '.bin', dtype=np.uint8, mode='c')
+    for name, entry in index.items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        array = blob[entry['offset']:entry['offset'] + count * dtype.itemsize]
+        state_dict[name] = torch.from_numpy(
+            array.view(dtype).reshape(entry['shape']))
+    return state_dict
+
+
+def bind_state_dict(module, state_dict):
+    '''
+        load state_dict into module without copying
+        parameters and buffers take the tensors of state_dict as their data, so with
+        memory-mapped blobs the module shares memory with the checkpoint file
+        the tensors must already have the device, dtype and shape of the module's
+    '''
+    own = module.state_dict(keep_vars=True)
+    if set(own) != set(state_dict):
+        raise KeyError(
+            f'state dict keys do not match: {sorted(set(own) ^ set(state_dict))}')
+    for name, tensor in state_dict.items():
+        target = own[name]
+        if target.shape != tensor.shape or target.dtype != tensor.dtype or target.device != tensor.device:
+            raise ValueError(f'cannot bind {name}: {tuple(tensor.shape)} {tensor.dtype} {tensor.device}, '
+                             f'expected {tuple(target.shape)} {target.dtype} {target.device}')
+        target.data = tensor
+
+
+def has_tensor_blob(path):
+    return os.path.isfile(path + '.json') and os.path.isfile(path + '.bin')
+
+
+def load_state_dict_file(path, map_location='cpu'):
+    '''
+        load a state dict saved with save_tensor_blob, or a legacy torch.save file
+    '''
+    if has_tensor_blob(path):
+        return load_tensor_blob(path)
+    return torch.load(path, map_location=map_location)
+
+
+def save_checkpoint(path, checkpoint):
+    '''
+        save a checkpoint dict as a directory
+        entries in TENSOR_COMPONENTS become tensor blobs, the rest is pickled to training.pt
+    '''
+    os.makedirs(path, exist_ok=True)
+    components = [name for name in TENSOR_COMPONENTS if name in checkpoint]
+    for name in components:
+        save_tensor_blob(os.path.join(path, name), checkpoint[name])
+    training = {key: value for key, value in checkpoint.items()
+                if key not in TENSOR_COMPONENTS and key != CONFIG_COMPONENT}
+    torch.save(training, os.path.join(path, 'training.pt'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'components': components,
+                   CONFIG_COMPONENT: checkpoint.get(CONFIG_COMPONENT)}, f)
+
+
+def load_checkpoint(path, training=True, map_location='cpu'):
+    '''
+    load a checkpoint saved by save_checkpoint (or a legacy single-file checkpoint)
+
+    Args:
+        path : checkpoint path
+        training : also load optimizers, schedulers and training state
+        map_location : map location of training.pt
+    return:
+        checkpoint : dict with the same entries as the saved one
+    '''
+    path = resolve_checkpoint(path)
+    if os.path.isfile(path):
+        return torch.load(path, map_location=map_location)
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    checkpoint = {}
+    if meta.get(CONFIG_COMPONENT) is not None:
+        checkpoint[CONFIG_COMPONENT] = meta[CONFIG_COMPONENT]
+    for name in meta['components']:
+        checkpoint[name] = load_tensor_blob(os.path.join(path, name))
+    if training:
+        checkpoint.update(torch.load(os.path.join(
+            path, 'training.pt'), map_location=map_location))
+    return checkpoint
+
+
+def resolve_checkpoint(path):
+    '''
+        path, or the previous checkpoint moved aside when a write was interrupted while replacing it
+    '''
+    if not os.path.exists(path) and os.path.exists(path + OLD_SUFFIX):
+        return path + OLD_SUFFIX
+    return path
+
+
+def checkpoint_pattern(prefix, suffix):
+    return re.compile(re.escape(prefix) + r'(\d+)(_best)?' + re.escape(suffix) + '$')
+
+
+def list_checkpoints(save_dir, pattern):
+    '''
+        (step, is_best, file name) of checkpoints in save_dir whose name matches pattern
+    '''
+    result = []
+    for name in os.listdir(save_dir):
+        match = pattern.match(name)
+        if match:
+            result.append(
+                (int(match.group(1)), match.group(2) is not None, name))
+    return result
+
+
+def read_model_config(path):
+    '''
+        model config (num_users, num_items, model) saved with a checkpoint, None for old checkpoints
+    '''
+    path = resolve_checkpoint(path)
+    if os.path.isfile(path):
+        return torch.load(path, map_location='cpu').get(CONFIG_COMPONENT)
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f).get(CONFIG_COMPONENT)
+
+
+def checkpoint_version(path):
+    '''
+        identifier that changes whenever the checkpoint at path is rewritten
+    '''
+    path = resolve_checkpoint(path)
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    stat = os.stat(path)
+    return f'{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}'
+
+
+def to_cpu(state):
+    '''
+        copy the tensors of a (nested) state dict to cpu
+        the copy is a snapshot, later in-place updates of the training state do not reach it
+    '''
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        snapshot = copy.copy(state)
+        for key, value in state.items():
+            snapshot[key] = to_cpu(value)
+        return snapshot
+    if isinstance(state, list):
+        return [to_cpu(value) for value in state]
+    if isinstance(state, tuple):
+        return tuple(to_cpu(value) for value in state)
+    return copy.deepcopy(state)
+
+
+class CheckpointWriter():
+    """
+        Writes checkpoints (see save_checkpoint) from a background thread.
+        A cpu snapshot is taken when save is called, the checkpoint is written to a
+        temporary path and renamed, so a checkpoint is always complete.
+        After each write, the oldest checkpoints written by this writer are removed so
+        that only its last keep_last regular and keep_best best checkpoints remain
+        (-1 : keep all). Other checkpoints in save_dir (e.g. of earlier runs) are never removed.
+
+        Checkpoint names are {prefix}{step}{suffix} and {prefix}{step}_best{suffix}.
+    """
+
+    def __init__(self, save_dir, prefix, suffix, keep_last=-1, keep_best=-1, async_write=True):
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.async_write = async_write
+        self.pattern = checkpoint_pattern(prefix, suffix)
+        # paths written by this writer, oldest first
+        self.written = {False: [], True: []}
+
+        self.error = None
+        self.queue = queue.Queue()
+        if self.async_write:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def save(self, state, path):
+        '''
+            snapshot state and write it to path
+        '''
+        self.raise_error()
+        snapshot = to_cpu(state)
+        if self.async_write:
+            self.queue.put((snapshot, path))
+        else:
+            self.write(snapshot, path)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def write(self, snapshot, path):
+        tmp_path = path + '.tmp'
+        remove_checkpoint(tmp_path)
+        save_checkpoint(tmp_path, snapshot)
+        # a directory cannot be replaced by a rename, so the previous checkpoint is
+        # moved aside and only removed once the new one is in place
+        old_path = path + OLD_SUFFIX
+        if os.path.exists(path):
+            remove_checkpoint(old_path)
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        remove_checkpoint(old_path)
+        self.record(path)
+        self.apply_retention()
+
+    def record(self, path):
+        match = self.pattern.match(os.path.basename(path))
+        if match is None:
+            return
+        written = self.written[match.group(2) is not None]
+        if path in written:
+            written.remove(path)
+        written.append(path)
+
+    def checkpoints(self):
+        '''
+            (step, is_best, file name) of checkpoints in save_dir
+        '''
+        return list_checkpoints(self.save_dir, self.pattern)
+
+    def apply_retention(self):
+        '''
+            remove all but the last keep_last regular and keep_best best checkpoints written by this writer
+            best checkpoints are only written on improvement, so the latest ones are the best ones
+        '''
+        for is_best, keep in [(False, self.keep_last), (True, self.keep_best)]:
+            written = self.written[is_best]
+            while keep >= 0 and len(written) > keep:
+                remove_checkpoint(written.pop(0))
+
+    def wait(self):
+        '''
+            block until every submitted checkpoint is written
+        '''
+        if self.async_write:
+            self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.async_write and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint writing failed') from error
+
+
+def remove_checkpoint(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
@@ -5,16 +5,14 @@ import shutil
 import torch.utils.data as data
 import tempfile
 import os
-import wget
 import zipfile
 from pathlib import Path
-from options import args
 
 ROOT_FOLDER = "Data"
 
 
 class DataLoader():
-    def __init__(self, args, pretraining):
+    def __init__(self, args, pretraining, load_data=True):
         '''
         Args:
             data_path : path of file containing target data
@@ -29,6 +27,8 @@ class DataLoader():
             default_rating : padding options
             pretraining : when used for pretraining or single bert model
             pretraining_batch_size : batch size during pretraining
+            load_data : preprocess the dataset, without it only task building
+                        functions (e.g. make_inference_task) can be used
         '''
 
         # make data directory
@@ -40,16 +40,20 @@ class DataLoader():
         self.random_seed = args.random_seed
         self.num_query_set = args.num_query_set
         self.min_seq_len = args.min_sequence
+        self.chunk_size = args.chunk_size
+        self.kcore_max_iter = args.kcore_max_iter
+        self.args = args
+        self.num_samples = args.num_samples
 
-        self.df, self.umap, self.smap = self.preprocessing(
-            args.data_path, args.min_sequence, args.min_item, args.mode)
+        if load_data:
+            self.df, self.umap, self.smap = self.preprocessing(
+                args.data_path, args.min_sequence, args.min_item, args.mode)
 
-        self.num_samples = args.num_samples
-        self.train_set, self.valid_set, self.test_set = self.split_data(
-            self.df, args.num_test_data)
-        self.num_items = len(self.smap)
-        self.num_users = len(self.umap)
-        self.total_data_num = len(self.df)
+            self.train_set, self.valid_set, self.test_set = self.split_data(
+                self.df, args.num_test_data)
+            self.num_items = len(self.smap)
+            self.num_users = len(self.umap)
+            self.total_data_num = len(self.df)
 
         self.default_rating = args.default_rating
 
@@ -59,13 +63,19 @@ class DataLoader():
         self.batch_idxs = []
         self.batch_idx = 0
 
+        # length bucketed batches of train users
+        self.bucket_by_length = args.bucket_by_length
+        self.num_length_buckets = args.num_length_buckets
+        self.task_batches = []
+
         # task information:
         self.task_info_rating_mean = args.task_info_rating_mean
         self.task_info_rating_std = args.task_info_rating_std
         self.task_info_labels = args.task_info_labels
 
         # for pretraining (learn sigle bert)
-        if pretraining and args.pretraining_batch_size != None:
+        self.pretraining_num_workers = args.pretraining_num_workers
+        if load_data and pretraining and args.pretraining_batch_size != None:
             self.pretraining_train_loader = self.make_pretraining_dataloader(
                 self.train_set, args.pretraining_batch_size)
             self.pretraining_valid_loader = self.make_pretraining_dataloader(
@@ -82,7 +92,7 @@ class DataLoader():
             data_path : path of file containing target data
             min_sequence : minimum sequence used to filter users
             min_item : minimum item size used to filter items
-            mode : "amazon" or "yelp" or "ml-1m" or "ml-10m"
+            mode : "amazon" or "yelp" or "ml-1m" or "ml-10m" or "synthetic"
 
         return:
             df : preprocessed data
@@ -100,18 +110,19 @@ class DataLoader():
             raw_df = pd.read_csv(data_path, sep='::',
                                  header=None, engine="python")
             raw_df.columns = ['user_id', 'product_id', 'rating', 'date']
-        elif mode == "amazon":
-            # choose appropriate columns
-            raw_df = pd.read_csv(data_path, usecols=[
-                'rating', 'reviewerID', 'product_id', 'date'])
-            raw_df.rename(columns={'reviewerID': 'user_id'}, inplace=True)
-        elif mode == "yelp":
-            # choose appropriate columns
-            raw_df = pd.read_csv(data_path, usecols=[
-                'stars', 'user_id', 'business_id', 'timestamp'])
-            raw_df.rename(columns={'business_id': 'product_id'}, inplace=True)
-            raw_df.rename(columns={'timestamp': 'date'}, inplace=True)
-            raw_df.rename(columns={'stars': 'rating'}, inplace=True)
+        elif mode == "synthetic":
+            # generated interactions, no data file or download needed
+            raw_df = synthetic_interactions(
+                self.args.synthetic_num_users, self.args.synthetic_num_items,
+                mean_length=self.args.synthetic_mean_length, length_sigma=self.args.synthetic_length_sigma,
+                min_length=min_sequence, item_zipf=self.args.synthetic_item_zipf,
+                rating_skew=self.args.synthetic_rating_skew, seed=self.random_seed)
+        elif mode == "amazon" or mode == "yelp":
+            # large csv files are streamed chunk by chunk
+            df, umap, smap = self.stream_preprocessing(
+                data_path, min_sequence, min_item, mode)
+            print("Preprocessing Finished!")
+            return df, umap, smap
 
         # filter user with lack of reviews
         raw_df = self.filter_triplets(raw_df, min_sequence, min_item)
@@ -135,6 +146,142 @@ class DataLoader():
         print("Preprocessing Finished!")
         return df, umap, smap
 
+    def read_csv_chunks(self, data_path, mode):
+        '''
+        read amazon or yelp csv file chunk by chunk
+        only needed columns are read and renamed to user_id, product_id, rating, date
+
+        Args:
+            data_path : path of file containing target data
+            mode : "amazon" or "yelp"
+        return:
+            iterator over dataframe chunks
+        '''
+        if mode == "amazon":
+            columns = {'reviewerID': 'user_id', 'product_id': 'product_id',
+                       'rating': 'rating', 'date': 'date'}
+            id_columns = ['reviewerID', 'product_id']
+        else:
+            columns = {'user_id': 'user_id', 'business_id': 'product_id',
+                       'stars': 'rating', 'timestamp': 'date'}
+            id_columns = ['user_id', 'business_id']
+
+        reader = pd.read_csv(data_path, usecols=list(columns.keys()),
+                             dtype={column: str for column in id_columns}, chunksize=self.chunk_size)
+        for chunk in reader:
+            # reviews without user or item id can't be attributed
+            yield chunk.rename(columns=columns).dropna(subset=['user_id', 'product_id'])
+
+    def encode_ids(self, values, id_codes, counts):
+        '''
+        map raw ids of a chunk to integer codes and count them, registering unseen ids
+        work is proportional to the chunk, not to the number of ids seen so far
+        Args:
+            values : raw ids of current chunk
+            id_codes : dict of raw ids seen so far => code (in order of appearance), extended in place
+            counts : occurrences of each code so far, may be longer than id_codes
+        return:
+            codes : integer codes of values
+            counts : updated counts, grown by doubling when needed
+        '''
+        inverse, uniques = pd.factorize(values)
+        unique_codes = np.fromiter((id_codes.setdefault(value, len(id_codes)) for value in uniques),
+                                   dtype=np.int64, count=len(uniques))
+        if len(id_codes) > len(counts):
+            grown = np.zeros(max(len(id_codes), 2 * len(counts)), dtype=np.int64)
+            grown[:len(counts)] = counts
+            counts = grown
+        # codes of uniques are distinct, so the fancy-indexed add is exact
+        counts[unique_codes] += np.bincount(inverse, minlength=len(uniques))
+        return unique_codes[inverse], counts
+
+    def stream_preprocessing(self, data_path, min_sequence, min_item, mode):
+        '''
+        Preprocessing large csv data with bounded memory
+
+        first pass : count reviews of each user and item chunk by chunk
+        second pass : keep only rows that can survive filtering as compact arrays
+        then k-core filter, sort by (user, date) and split into per-user arrays
+
+        Args:
+            data_path : path of file containing target data
+            min_sequence : minimum sequence used to filter users
+            min_item : minimum item size used to filter items
+            mode : "amazon" or "yelp"
+
+        return:
+            df : preprocessed data
+            umap : user ids
+            smap : product ids
+        '''
+        user_codes_of, item_codes_of = {}, {}
+        user_counts = np.zeros(0, dtype=np.int64)
+        item_counts = np.zeros(0, dtype=np.int64)
+
+        # first pass : count reviews
+        for chunk in self.read_csv_chunks(data_path, mode):
+            _, user_counts = self.encode_ids(
+                chunk['user_id'].to_numpy(), user_codes_of, user_counts)
+            _, item_counts = self.encode_ids(
+                chunk['product_id'].to_numpy(), item_codes_of, item_counts)
+        # raw ids by code
+        user_index = pd.Index(list(user_codes_of), dtype=object)
+        item_index = pd.Index(list(item_codes_of), dtype=object)
+        del user_codes_of, item_codes_of
+
+        # users or items with less reviews than the minimum can't survive filtering
+        good_items = item_counts[:len(item_index)] >= min_item
+        candidate_users = user_counts[:len(user_index)] >= min_sequence
+
+        # second pass : collect surviving rows
+        users, items, ratings, dates = [], [], [], []
+        for chunk in self.read_csv_chunks(data_path, mode):
+            user_codes = user_index.get_indexer(chunk['user_id'].to_numpy())
+            item_codes = item_index.get_indexer(chunk['product_id'].to_numpy())
+            keep = good_items[item_codes] & candidate_users[user_codes]
+
+            date = chunk['date'].to_numpy()[keep]
+            if date.dtype.kind not in 'iuf':
+                date = date.astype(str)
+
+            users.append(user_codes[keep].astype(np.int32))
+            items.append(item_codes[keep].astype(np.int32))
+            ratings.append(chunk['rating'].to_numpy(dtype=np.float32)[keep])
+            dates.append(date)
+
+        users = np.concatenate(users)
+        items = np.concatenate(items)
+        ratings = np.concatenate(ratings)
+        dates = np.concatenate(dates)
+
+        # filter user and item with lack of reviews
+        keep = self.k_core_filter(users, items, min_sequence, min_item)
+        users, items, ratings, dates = users[keep], items[keep], ratings[keep], dates[keep]
+        print("total number of data", len(users))
+
+        # sort by (user, date) => make sequence
+        order = np.lexsort((dates, users))
+        users, items, ratings = users[order], items[order], ratings[order]
+        del dates, order
+
+        # map user or product id => int
+        user_codes, starts = np.unique(users, return_index=True)
+        item_codes = np.unique(items)
+        item_lookup = np.zeros(len(item_index), dtype=np.int64)
+        item_lookup[item_codes] = np.arange(1, len(item_codes)+1)
+        product_ids = item_lookup[items]
+        umap = dict(zip(user_index[user_codes], range(len(user_codes))))
+        smap = dict(zip(item_index[item_codes], range(1, len(item_codes)+1)))
+
+        df = pd.DataFrame(
+            data={
+                'user_id': np.arange(len(user_codes)),
+                'product_id': np.split(product_ids, starts[1:]),
+                'rating': np.split(ratings, starts[1:]),
+            }
+        )
+        return df, umap, smap
+
     def download_raw_movielnes_data(self, mode):
         '''
             This function downloads movielens-1m, movielens-10m
@@ -155,6 +302,8 @@ class DataLoader():
 
         print("Raw file doesn't exist. Downloading...")
         if True:
+            # wget is only needed for the first download
+            import wget
             tmproot = Path(tempfile.mkdtemp())
             tmpzip = tmproot.joinpath('file.zip')
             tmpfolder = tmproot.joinpath('folder')
@@ -198,18 +347,52 @@ class DataLoader():
         return:
             df : filtered data
         '''
-        item_sizes = df.groupby('product_id').size()
-        good_items = item_sizes.index[item_sizes >= min_item]
-        df = df[df['product_id'].isin(good_items)]
-
-        user_sizes = df.groupby('user_id').size()
-        good_users = user_sizes.index[user_sizes >= min_sequence]
-        df = df[df['user_id'].isin(good_users)]
+        # factorize codes missing ids as -1
+        df = df.dropna(subset=['user_id', 'product_id'])
+        user_codes, _ = pd.factorize(df['user_id'])
+        item_codes, _ = pd.factorize(df['product_id'])
+        keep = self.k_core_filter(
+            user_codes, item_codes, min_sequence, min_item)
+        df = df.iloc[keep]
 
         print("total number of data", len(df))
 
         return df
 
+    def k_core_filter(self, user_codes, item_codes, min_sequence, min_item):
+        '''
+        iterative k-core filtering on integer coded reviews
+        items and users are filtered alternately until every remaining item has
+        at least min_item reviews and every remaining user at least min_sequence
+        reviews, or until kcore_max_iter iterations (-1 : no limit, at least one)
+
+        Args:
+            user_codes: integer user code of each review
+            item_codes: integer item code of each review
+            min_sequence: minimum reviews users should have
+            min_item: minimum reviews items should have
+        return:
+            keep : indices of surviving reviews
+        '''
+        num_users = user_codes.max() + 1 if len(user_codes) else 0
+        num_items = item_codes.max() + 1 if len(item_codes) else 0
+        keep = np.arange(len(user_codes))
+        num_iter = 0
+        while self.kcore_max_iter < 0 or num_iter < max(self.kcore_max_iter, 1):
+            num_iter += 1
+            num_kept = len(keep)
+
+            item_sizes = np.bincount(item_codes[keep], minlength=num_items)
+            keep = keep[item_sizes[item_codes[keep]] >= min_item]
+
+            user_sizes = np.bincount(user_codes[keep], minlength=num_users)
+            keep = keep[user_sizes[user_codes[keep]] >= min_sequence]
+
+            if len(keep) == num_kept:
+                break
+        print("k-core filtering iterations", num_iter)
+        return keep
+
     def densify_index(self, df):
         '''
         densify index - map id => int number with range(0, num_ids)
@@ -237,7 +420,9 @@ class DataLoader():
         test_data = df.iloc[test_idxs]
         used_df = df.iloc[train_valid_idxs]
         np.random.seed()
-        random_selection = np.random.rand(len(used_df.index)) <= 0.85
+        # fixed train/valid split so that frozen valid tasks stay held out
+        random_selection = np.random.RandomState(
+            self.random_seed).rand(len(used_df.index)) <= 0.85
         train_data = used_df[random_selection]
         valid_data = used_df[~random_selection]
         return train_data, valid_data, test_data
@@ -309,9 +494,9 @@ class DataLoader():
             ratings_adapt = ratings[start_idx:]
             product_ids_adapt = product_ids[start_idx:]
             query_rating = [0] * (self.max_sequence_length -
-                                  len(ratings_adapt)) + ratings_adapt
+                                  len(ratings_adapt)) + list(ratings_adapt)
             query_product_id = [0] * (self.max_sequence_length -
-                                      len(product_ids_adapt)) + product_ids_adapt
+                                      len(product_ids_adapt)) + list(product_ids_adapt)
             query_rating = torch.FloatTensor(query_rating)
             query_product_id = torch.LongTensor(query_product_id)
 
@@ -414,44 +599,183 @@ class DataLoader():
         function that makes task information about rating
         normalization option : rating with range(0,1)
 
+        statistics come from a single histogram of the support ratings and are
+        broadcast over (n_support, seq_len) as expanded views
+
         return:
             num_i : # of ratings with i value / # of total ratings with all values
             rating_mean: mean value of ratings
             rating_std: std value of ratings
         '''
-        # total_ratings = (ratings > 0).sum()
-        num_1 = int((ratings == 1).sum().item())
-        num_2 = int((ratings == 2).sum().item())
-        num_3 = int((ratings == 3).sum().item())
-        num_4 = int((ratings == 4).sum().item())
-        num_5 = int((ratings == 5).sum().item())
+        # histogram of rating values 1 ~ 5 (padding and other values are ignored)
+        is_rating = (ratings >= 1) & (ratings <= 5) & (ratings == ratings.round())
+        hist = torch.bincount(
+            ratings[is_rating].long(), minlength=6)[1:].double()
+        values = torch.arange(1, 6, dtype=torch.float64)
+
+        # moments from histogram (unbiased std as torch.std)
+        num = hist.sum()
+        rating_mean = (hist * values).sum() / num
+        rating_var = ((hist * values**2).sum() - num *
+                      rating_mean**2) / (num - 1)
+        rating_std = rating_var.clamp(min=0).sqrt()
+        if normalized:
+            rating_mean = rating_mean / 5.0
+            rating_std = rating_std / 5.0
 
-        rating_info = num_1 * [1] + num_2 * [2] + \
-            num_3*[3] + num_4*[4] + num_5 * [5]
+        stats = self.task_info_rating_mean * \
+            [rating_mean] + self.task_info_rating_std*[rating_std]
 
-        rating_info = torch.FloatTensor(rating_info)
+        n, seq_len = ratings.shape
+        rating_info = []
+        if stats:
+            rating_info.append(torch.stack(stats).float().view(
+                1, 1, -1).expand(n, seq_len, len(stats)))
+        if self.task_info_labels:
+            rating_info.append(ratings.unsqueeze(2)/5.0)
+
+        if len(rating_info) > 1:
+            return torch.cat(rating_info, dim=2)
+        elif rating_info:
+            return rating_info[0]
+        return rating_info
 
-        if normalized:
-            rating_mean = (rating_info/5.0).mean()
-            rating_std = (rating_info/5.0).std()
-        else:
-            rating_mean = rating_info.mean()
-            rating_std = rating_info.std()
-        rating_info = self.task_info_rating_mean * \
-            [rating_mean] + self.task_info_rating_std*[rating_std]
+    def get_data_set(self, mode):
+        '''
+            users of train, valid or test split
+        '''
+        if mode == "train":
+            return self.train_set
+        elif mode == "valid":
+            return self.valid_set
+        elif mode == "test":
+            return self.test_set
 
-        if rating_info:
-            rating_info = torch.stack(rating_info)
-            rating_info = rating_info.repeat(
-                len(ratings), self.max_sequence_length, 1)
-            if self.task_info_labels:
-                rating_info = torch.cat(
-                    (rating_info, ratings.unsqueeze(2)/5.0), dim=2)
+    def make_task(self, data, mode, normalized=False, use_label=True):
+        '''
+        make a single task from user data
 
-        else:
-            if self.task_info_labels:
-                rating_info = ratings.unsqueeze(2)/5.0
-        return rating_info
+        Args:
+            data : row of train, valid or test set
+            mode : train or valid or test
+            normalized : use normalized version of ratings
+        return:
+            task : (support_set, query_set, task_info)
+        '''
+        user_id = torch.tensor(data.user_id)
+        product_ids = data.product_id
+        ratings = data.rating
+
+        # subsamples
+        support_ratings, support_product_ids, query_ratings, query_product_ids, normalized_num_samples = self.preprocess_wt_subsampling(
+            product_ids, ratings, mode)
+
+        # make support set and query set
+        support_data, rating_info = self.make_support_set(
+            user_id, support_product_ids, support_ratings, normalized, use_label)
+
+        query_data = self.make_query_set(
+            user_id, query_product_ids, query_ratings)
+
+        # make task information
+        task_info = rating_info
+        return support_data, query_data, task_info
+
+    def make_inference_task(self, user_id, product_ids, ratings, target_product_ids, normalized=False, rng=None):
+        '''
+        make a task of a user outside the dataset
+
+        support set : sub-windows of the (latest max_seq_len) history, as in training
+        query set : the latest history followed by each target product, target ratings are 0
+
+        Args:
+            user_id : user id (0 for unknown users)
+            product_ids : product history (oldest first)
+            ratings : ratings of product history
+            target_product_ids : products to predict ratings for
+            normalized : use normalized version of ratings
+            rng : np.random.RandomState used to choose support sub-windows
+        return:
+            task : (support_set, query_set, task_info)
+        '''
+        if len(product_ids) != len(ratings):
+            raise ValueError('product_ids and ratings must have the same length')
+        if len(product_ids) < self.min_sub_window_size:
+            raise ValueError(
+                f'at least {self.min_sub_window_size} rated products are needed for adaptation')
+        if rng is None:
+            rng = np.random.RandomState(self.random_seed)
+
+        product_ids = list(product_ids)[-self.max_sequence_length:]
+        ratings = list(ratings)[-self.max_sequence_length:]
+        user_id = torch.tensor(user_id)
+
+        # every sub-window of the history is a support sample
+        cur_num_samples = (len(ratings)-self.min_sub_window_size+2) * \
+            (len(ratings)-self.min_sub_window_size+1)//2
+        num_subsamples = min(cur_num_samples, self.num_samples)
+        rand_idxs = rng.choice(cur_num_samples, num_subsamples, replace=False)
+        support_ratings = torch.FloatTensor(self.subsample(ratings, rand_idxs))
+        support_product_ids = torch.LongTensor(
+            self.subsample(product_ids, rand_idxs))
+        support_data, rating_info = self.make_support_set(
+            user_id, support_product_ids, support_ratings, normalized)
+
+        # one query row per target product
+        history_len = self.max_sequence_length - 1
+        query_product_ids = torch.LongTensor(
+            [[0] * (history_len - len(product_ids[-history_len:])) + product_ids[-history_len:] + [int(target)]
+             for target in target_product_ids])
+        query_ratings = torch.FloatTensor(
+            [[0] * (history_len - len(ratings[-history_len:])) + ratings[-history_len:] + [0]
+             for _ in target_product_ids])
+        query_data = self.make_query_set(
+            user_id, query_product_ids, query_ratings)
+        return support_data, query_data, rating_info
+
+    def make_incremental_support(self, user_id, product_ids, ratings, num_new, normalized=False, rng=None):
+        '''
+        support set of the sub-windows that end at one of the num_new latest interactions,
+        the windows an appended interaction adds to make_inference_task
+
+        Args:
+            user_id : user id (0 for unknown users)
+            product_ids : product history including the new products (oldest first)
+            ratings : ratings of product history
+            num_new : the number of new interactions at the end of the history
+            normalized : use normalized version of ratings
+            rng : np.random.RandomState used to choose support sub-windows
+        return:
+            support_set, task_info
+        '''
+        if len(product_ids) != len(ratings):
+            raise ValueError('product_ids and ratings must have the same length')
+        if rng is None:
+            rng = np.random.RandomState(self.random_seed)
+
+        product_ids = list(product_ids)[-self.max_sequence_length:]
+        ratings = list(ratings)[-self.max_sequence_length:]
+        num_new = min(num_new, len(ratings) - self.min_sub_window_size + 1)
+        if num_new <= 0:
+            raise ValueError(
+                f'at least {self.min_sub_window_size} rated products are needed for adaptation')
+
+        # (start, end) of every window ending at a new interaction
+        windows = [(end - window_size, end)
+                   for end in range(len(ratings) - num_new + 1, len(ratings) + 1)
+                   for window_size in range(self.min_sub_window_size, end + 1)]
+        num_subsamples = min(len(windows), self.num_samples)
+        rand_idxs = rng.choice(len(windows), num_subsamples, replace=False)
+
+        def pad(values, start, end):
+            return [0] * (self.max_sequence_length - (end - start)) + values[start:end]
+
+        support_ratings = torch.FloatTensor(
+            [pad(ratings, *windows[idx]) for idx in rand_idxs])
+        support_product_ids = torch.LongTensor(
+            [pad(product_ids, *windows[idx]) for idx in rand_idxs])
+        return self.make_support_set(
+            torch.tensor(user_id), support_product_ids, support_ratings, normalized)
 
     def generate_task(self, mode="train", batch_size=20, normalized=False, use_label=True):
         '''
@@ -464,15 +788,13 @@ class DataLoader():
         return:
             tasks : batch of (support_set, query_set, task_info)
         '''
-        if mode == "train":
-            data_set = self.train_set
-        elif mode == "valid":
-            data_set = self.valid_set
-        elif mode == "test":
-            data_set = self.test_set
+        data_set = self.get_data_set(mode)
         tasks = []
 
-        if mode == "train":
+        if mode == "train" and self.bucket_by_length:
+            idxs = self.next_bucketed_batch(data_set, batch_size)
+
+        elif mode == "train":
             if len(self.batch_idxs) == 0:
                 self.batch_idxs = np.random.choice(len(data_set.index),
                                                    len(data_set.index), replace=False)
@@ -490,51 +812,237 @@ class DataLoader():
                                     batch_size, replace=False)
 
         for i in idxs:
-            data = data_set.iloc[i]
-            user_id = torch.tensor(data.user_id)
-            product_ids = data.product_id
-            ratings = data.rating
+            tasks.append(self.make_task(
+                data_set.iloc[i], mode, normalized, use_label))
 
-            # subsamples
-            support_ratings, support_product_ids, query_ratings, query_product_ids, normalized_num_samples = self.preprocess_wt_subsampling(
-                product_ids, ratings, mode)
+        return tasks
 
-            # make support set and query set
-            support_data, rating_info = self.make_support_set(
-                user_id, support_product_ids, support_ratings, normalized, use_label)
+    def make_length_buckets(self, data_set, batch_size):
+        '''
+        split users into task batches of users with similar history length
+        users are bucketed by quantiles of their history length capped at
+        max_sequence_length, shuffled within their bucket and cut into batches.
+        batch order is shuffled, and every user appears in exactly one batch
 
-            query_data = self.make_query_set(
-                user_id, query_product_ids, query_ratings)
+        Args:
+            data_set : train set
+            batch_size : task batch size
+        return:
+            batches : list of user index arrays
+        '''
+        lengths = np.minimum(data_set['product_id'].map(
+            len).to_numpy(), self.max_sequence_length)
+        edges = np.unique(np.quantile(lengths, np.linspace(
+            0, 1, self.num_length_buckets+1)[1:-1]))
+        bucket_ids = np.digitize(lengths, edges)
+
+        batches = []
+        for bucket in np.unique(bucket_ids):
+            members = np.random.permutation(np.nonzero(bucket_ids == bucket)[0])
+            batches += [members[i:i+batch_size]
+                        for i in range(0, len(members), batch_size)]
+        order = np.random.permutation(len(batches))
+        return [batches[i] for i in order]
+
+    def next_bucketed_batch(self, data_set, batch_size):
+        '''
+            next length bucketed batch of train users, new buckets are drawn every epoch
+        '''
+        if self.batch_idx >= len(self.task_batches):
+            if len(self.task_batches) > 0:
+                print("Train All Users")
+            self.task_batches = self.make_length_buckets(data_set, batch_size)
+            self.batch_idx = 0
+        idxs = self.task_batches[self.batch_idx]
+        self.batch_idx += 1
+        return idxs
+
+    def state_dict(self):
+        '''
+            position of the train sampler, used to resume training mid-epoch
+        '''
+        return {
+            'batch_idxs': np.asarray(self.batch_idxs),
+            'batch_idx': self.batch_idx,
+            'task_batches': list(self.task_batches),
+        }
 
-            # make task information
-            task_info = rating_info
-            tasks.append((support_data, query_data, task_info))
+    def load_state_dict(self, state):
+        '''
+            restore the train sampler position saved by state_dict
+        '''
+        self.batch_idxs = state['batch_idxs']
+        self.batch_idx = state['batch_idx']
+        self.task_batches = state['task_batches']
 
-        return tasks
+    def iter_tasks(self, mode="test", num_tasks=1000, batch_size=20, normalized=False, use_label=True, seed=None):
+        '''
+        lazily generate tasks of valid or test users, batch_size tasks at a time
+        only one chunk of tasks is kept in memory
 
-    def make_pretraining_dataloader(self, df, batch_size=128, num_queries=1):
+        Args:
+            mode : valid or test
+            num_tasks : total number of tasks (at most the number of users of mode)
+            batch_size : number of tasks per chunk
+            normalized : use normalized version of ratings
+            seed : if given, tasks are drawn from a random state seeded with seed
+                   (the global random state seen by the caller is left untouched),
+                   the same seed gives the same tasks as seeding generate_task
+        return:
+            iterator over batches of (support_set, query_set, task_info)
+        '''
+        data_set = self.get_data_set(mode)
+        if num_tasks > len(data_set.index):
+            # small datasets (e.g. synthetic) have fewer users than requested tasks
+            print(f'Only {len(data_set.index)} {mode} users, '
+                  f'evaluating {len(data_set.index)} instead of {num_tasks} tasks')
+            num_tasks = len(data_set.index)
+
+        if seed is not None:
+            outer_state = np.random.get_state()
+            np.random.seed(seed)
+        # whether the global random state is the task state (restored on exit)
+        swapped = seed is not None
+
+        try:
+            idxs = np.random.choice(len(data_set.index), num_tasks, replace=False)
+            for start in range(0, num_tasks, batch_size):
+                tasks = [self.make_task(data_set.iloc[i], mode, normalized, use_label)
+                         for i in idxs[start:start+batch_size]]
+
+                # switch back to the caller random state while tasks are consumed
+                if seed is not None:
+                    task_state = np.random.get_state()
+                    np.random.set_state(outer_state)
+                    swapped = False
+                yield tasks
+                if seed is not None:
+                    outer_state = np.random.get_state()
+                    np.random.set_state(task_state)
+                    swapped = True
+        finally:
+            if swapped:
+                np.random.set_state(outer_state)
+
+    def make_pretraining_dataloader(self, df, batch_size=128, num_queries=1, rank=0, world_size=1):
         '''
         funtion that makes dataloader for pretraining(single bert model)
         Args:
             df: data(train or valid)
             batch_size: training batch size
+            rank: rank of this process for data parallel pretraining
+            world_size: number of data parallel processes, each one gets a shard of users
         return:
             dataloader: torch dataloader
         '''
-        dataset = SequenceDataset(
+        dataset = BatchSequenceDataset(
             df, self.max_sequence_length, self.min_sub_window_size, self.default_rating, num_queries)
+
+        # the sampler yields lists of indices, so the dataset builds whole batches
+        if world_size > 1:
+            user_sampler = data.distributed.DistributedSampler(
+                dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        else:
+            user_sampler = data.RandomSampler(dataset)
+        sampler = data.BatchSampler(
+            user_sampler, batch_size=batch_size, drop_last=False)
         dataloader = torch.utils.data.DataLoader(
             dataset,
-            batch_size=batch_size,
-            shuffle=True
+            batch_size=None,
+            sampler=sampler,
+            num_workers=self.pretraining_num_workers,
+            persistent_workers=self.pretraining_num_workers > 0,
+            worker_init_fn=seed_worker
         )
 
         return dataloader
 
 
-class SequenceDataset(data.Dataset):
+def synthetic_interactions(num_users, num_items, mean_length=30, length_sigma=1.0, min_length=5,
+                           item_zipf=1.0, rating_skew=0.0, seed=0):
+    '''
+    generate (user_id, product_id, rating, date) interactions
+
+    Args:
+        num_users : the number of users
+        num_items : the number of items
+        mean_length : median history length, lengths are log-normal
+        length_sigma : spread of log history lengths (0 : every user has mean_length interactions)
+        min_length : minimum history length
+        item_zipf : exponent of zipf item popularity (0 : uniform)
+        rating_skew : ratings 1..5 are drawn with probability ~ exp(rating_skew * rating)
+                      (0 : uniform, > 0 : skewed to high ratings)
+        seed : random seed
+    return:
+        df : interactions in the raw format of the other datasets
+    '''
+    rng = np.random.RandomState(seed)
+    lengths = np.maximum(min_length, np.round(
+        rng.lognormal(np.log(mean_length), length_sigma, size=num_users))).astype(np.int64)
+
+    item_weights = 1.0 / np.arange(1, num_items + 1) ** item_zipf
+    item_weights /= item_weights.sum()
+    rating_weights = np.exp(rating_skew * np.arange(1, 6))
+    rating_weights /= rating_weights.sum()
+
+    total = int(lengths.sum())
+    user_ids = np.repeat(np.arange(num_users), lengths)
+    # dates increase within every user history
+    dates = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return pd.DataFrame({
+        'user_id': user_ids,
+        'product_id': rng.choice(num_items, size=total, p=item_weights),
+        'rating': rng.choice(np.arange(1, 6), size=total, p=rating_weights),
+        'date': dates,
+    })
+
+
+def seed_worker(worker_id):
+    '''
+        give each dataloader worker its own numpy random state
+    '''
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+def padding_start(product_history):
+    '''
+        index of the first column holding a real item in any row of a left padded batch
+    '''
+    real = (product_history.reshape(-1, product_history.size(-1))
+            > 0).any(dim=0).nonzero()
+    return real[0].item() if len(real) > 0 else product_history.size(-1)
+
+
+def trim_set(data, start):
+    '''
+        drop the first start columns of the histories of a support or query set
+    '''
+    user_id, product_history, target_product, rating_history, target_rating = data
+    return user_id, product_history[:, start:], target_product, rating_history[:, start:], target_rating
+
+
+def trim_task(task):
+    '''
+        trim support and query set of a task to their longest real sequence
+        columns that are padding in every row are removed, task information is
+        trimmed together with the support set (query may be None)
+    '''
+    support, query, task_info = task
+    start = padding_start(support[1])
+    support = trim_set(support, start)
+    if torch.is_tensor(task_info):
+        task_info = task_info[:, start:]
+    if query is not None:
+        query = trim_set(query, padding_start(query[1]))
+    return support, query, task_info
+
+
+class BatchSequenceDataset(data.Dataset):
     """
-        Pytorch dataset for review data
+        Array backed pytorch dataset for review data that returns whole batches.
+        Sequences of all users are concatenated into flat arrays with offsets, and
+        random windows of a batch of users are drawn and gathered with numpy at once.
+        Indexed with a list of user indices (use with a BatchSampler and batch_size=None).
     """
 
     def __init__(
@@ -546,62 +1054,70 @@ class SequenceDataset(data.Dataset):
             max_len: max sequence length
             min_sub_window_size : minimum window size during subsampling
             default_rating: rating of padding
+            num_queries: number of windows drawn for each user
         """
-        self.ratings_frame = df
         self.max_len = max_len
         self.min_sub_window_size = min_sub_window_size
         self.default_rating = default_rating
         self.num_queries = num_queries
 
+        self.user_ids = df['user_id'].to_numpy(dtype=np.int64)
+        self.lengths = df['product_id'].map(len).to_numpy(dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)[:-1]))
+        self.product_ids = np.concatenate(
+            [np.asarray(p, dtype=np.int64) for p in df['product_id']] + [np.zeros(1, dtype=np.int64)])
+        self.ratings = np.concatenate(
+            [np.asarray(r, dtype=np.float32) for r in df['rating']] + [np.zeros(1, dtype=np.float32)])
+
     def __len__(self):
-        return len(self.ratings_frame)
+        return len(self.lengths)
 
-    def preprocessing(self, product_ids, ratings):
+    def preprocessing(self, idxs):
         """
-            function that makes single random sequence for each user
-            sequence length ranges from min_sub_window_size to max_len
+            draw num_queries random windows for each user in idxs, vectorized over the batch
+            each user gets one random span of at most max_len items, its windows have
+            random sizes from min_sub_window_size to the span length and lie inside it
         """
-        seq_len = len(product_ids)
-        maximum_len = seq_len if seq_len < self.max_len else self.max_len
-
-        start_idx = np.random.randint(0, seq_len - maximum_len + 1)
-        product_lst = []
-        rating_lst = []
-        for _ in range(self.num_queries):
-            window_size = np.random.randint(
-                self.min_sub_window_size, maximum_len+1)
-            start_idx_im = np.random.randint(
-                start_idx, maximum_len - window_size + start_idx + 1)
-            product_ids_im = [0] * (self.max_len - window_size) + \
-                list(product_ids[start_idx_im: start_idx_im+window_size])
-            ratings_im = [0] * (self.max_len - window_size) + \
-                list(ratings[start_idx_im: start_idx_im+window_size])
-            product_ids_im = torch.LongTensor(product_ids_im).view(1, -1)
-            ratings_im = torch.FloatTensor(ratings_im).view(1, -1)
-            product_lst.append(product_ids_im)
-            rating_lst.append(ratings_im)
-        product_ids_f = torch.cat(product_lst, axis=0)
-        ratings_f = torch.cat(rating_lst, axis=0)
-        return product_ids_f, ratings_f
-
-    def __getitem__(self, idx):
-        data = self.ratings_frame.iloc[idx]
-        user_id = torch.tensor(data.user_id).reshape(1)
-        product_ids = data.product_id
-        ratings = data.rating
-
-        product_ids, ratings = self.preprocessing(
-            product_ids, ratings)
+        lengths = self.lengths[idxs]
+        maximum_len = np.minimum(lengths, self.max_len)
+
+        # one start per user, shared by its windows
+        start_idx = np.random.randint(0, lengths - maximum_len + 1)
+        start_idx = np.repeat(start_idx, self.num_queries)
+        maximum_len = np.repeat(maximum_len, self.num_queries)
+        offsets = np.repeat(self.offsets[idxs], self.num_queries)
+
+        window_size = np.random.randint(
+            self.min_sub_window_size, maximum_len+1)
+        start_idx_im = start_idx + \
+            np.random.randint(0, maximum_len - window_size + 1)
+
+        # left padded gather
+        pad_len = self.max_len - window_size
+        cols = np.arange(self.max_len)
+        real = cols[None, :] >= pad_len[:, None]
+        positions = start_idx_im[:, None] + cols[None, :] - pad_len[:, None]
+        flat_idxs = offsets[:, None] + np.where(real, positions, 0)
+        product_ids = np.where(real, self.product_ids[flat_idxs], 0)
+        ratings = np.where(real, self.ratings[flat_idxs], 0).astype(np.float32)
+        return product_ids, ratings
+
+    def __getitem__(self, idxs):
+        idxs = np.asarray(idxs)
+        b, q, l = len(idxs), self.num_queries, self.max_len
+
+        product_ids, ratings = self.preprocessing(idxs)
+        product_ids = torch.from_numpy(product_ids).view(b, q, l)
+        ratings = torch.from_numpy(ratings).view(b, q, l)
 
         # if we want default ratings 1
         ratings = ratings + self.default_rating*(ratings == 0)
 
-        b, l = ratings.shape
-        product_history = product_ids[:, :-1]
-        target_product_id = product_ids[:, -1:]
-        product_history_ratings = ratings[:, :-1]
-        target_product_rating = ratings[:, -1:]
-        user_id = user_id.repeat(
-            self.num_queries, 1)
+        product_history = product_ids[:, :, :-1]
+        target_product_id = product_ids[:, :, -1:]
+        product_history_ratings = ratings[:, :, :-1]
+        target_product_rating = ratings[:, :, -1:]
+        user_id = torch.from_numpy(self.user_ids[idxs]).view(
+            b, 1, 1).repeat(1, q, 1)
 
         return (user_id, product_history, target_product_id,  product_history_ratings), target_product_rating
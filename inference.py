@@ -0,0 +1,341 @@
+from main import MAML, checkpoint_path
+from dataloader import DataLoader, trim_task
+from checkpoint import checkpoint_version, read_model_config, resolve_checkpoint
+from weight_cache import AdaptedWeightsCache, history_fingerprint
+from options import parse_args
+
+import torch
+import copy
+import os
+import numpy as np
+from collections import OrderedDict
+
+
+class Predictor():
+    """
+        Adapt-and-predict for users outside the training data.
+
+        The meta-trained model, adaptive loss networks and learned inner learning
+        rates are loaded from a checkpoint, no dataset, optimizer or metrics sink is
+        created. For every user, the support set is built from the rated history,
+        the meta parameters are adapted with the inner loop of training and the
+        ratings of the requested products are predicted with the adapted parameters.
+        Adapted parameters are cached per user and history (AdaptedWeightsCache), so
+        repeated requests skip adaptation; the cache is cleared when the checkpoint
+        file is rewritten, which also reloads the model.
+        When the history only extends a cached one by a few interactions, the cached
+        parameters are warm-started: the last incremental_steps inner steps run on the
+        support windows that end at the new interactions. After incremental_max_updates
+        consecutive warm starts, the user is adapted from the meta parameters again.
+        For models with incremental inference, history_state encodes a history once,
+        append extends it by new interactions and score predicts targets after it
+        without encoding the history again.
+
+        predictor = Predictor(args, checkpoint_step=1750)
+        ratings = predictor.predict([3, 17, 25], [4, 5, 3], target_product_ids=[8, 9])
+    """
+
+    def __init__(self, args, checkpoint_step, best=True):
+        '''
+            Args:
+                args : options of the meta-trained model (model, mode, log_dir and model sizes)
+                checkpoint_step : checkpoint iteration to load
+                best : load the best checkpoint of checkpoint_step
+        '''
+        args = copy.copy(args)
+        path = checkpoint_path(args, checkpoint_step, best)
+        if not os.path.exists(resolve_checkpoint(path)):
+            path = checkpoint_path(args, checkpoint_step, best, ext='.pt')
+        if not os.path.exists(path):
+            raise ValueError(
+                f'No checkpoint for iteration {checkpoint_step} found.')
+
+        # embedding sizes come from the checkpoint (options for old checkpoints)
+        model_config = read_model_config(path)
+        if model_config is not None:
+            args.num_users = model_config['num_users']
+            args.num_items = model_config['num_items']
+        if args.num_items == 0:
+            raise ValueError(
+                'checkpoint has no model config, set --num_users and --num_items')
+
+        self.args = args
+        self.path = path
+        self.checkpoint_step = checkpoint_step
+        self.best = best
+        self.maml = MAML(args, load_data=False, training=False)
+        self.device = self.maml.device
+        self.cache = AdaptedWeightsCache(args.weight_cache_size, args.weight_cache_mb * 1024 ** 2,
+                                         args.weight_cache_rank, args.weight_cache_sparse_ratio)
+        # encoded histories of models with incremental inference
+        self.states = OrderedDict()
+        self.version = None
+        self.refresh()
+
+        # task building only, no preprocessing
+        self.task_builder = DataLoader(args, pretraining=False, load_data=False)
+        self.rng = np.random.RandomState(args.random_seed)
+
+    def refresh(self):
+        '''
+            (re)load the checkpoint when it changed on disk
+            return:
+                reloaded : whether the checkpoint was loaded
+        '''
+        version = checkpoint_version(self.path)
+        if version == self.version:
+            return False
+        self.maml.load(self.checkpoint_step, self.best, training=False)
+        self.maml.model.eval()
+        self.meta_weights = {name: weight.detach() for name, weight in
+                             self.maml.get_inner_loop_parameter_dict(self.maml.model.named_parameters()).items()}
+        self.cache.validate(version)
+        self.states = OrderedDict()
+        self.version = version
+        return True
+
+    def make_task(self, product_ids, ratings, target_product_ids, user_id=0):
+        task = self.task_builder.make_inference_task(
+            user_id, product_ids, ratings, target_product_ids, normalized=self.maml.normalize_loss, rng=self.rng)
+        if self.maml.trim_padding:
+            task = trim_task(task)
+        return task
+
+    def adapt(self, product_ids, ratings, user_id=0):
+        '''
+            adapted parameters of a user with rated history (product_ids, ratings)
+        '''
+        self.refresh()
+        support, _, task_info = self.make_task(
+            product_ids, ratings, [0], user_id)
+        return self.adapt_task(user_id, product_ids, ratings, support, task_info)
+
+    def previous_history(self, user_id, product_ids, ratings):
+        '''
+            (key, num_new, num_updates) of the longest cached prefix of the history
+            that may be warm-started, None when the user has to be adapted from scratch
+        '''
+        if self.args.incremental_steps <= 0:
+            return None
+        max_new = min(self.args.incremental_max_new, len(product_ids) - 1)
+        for num_new in range(1, max_new + 1):
+            key = history_fingerprint(
+                user_id, product_ids[:-num_new], ratings[:-num_new])
+            num_updates = self.cache.num_updates(key)
+            if num_updates is None:
+                continue
+            if num_updates >= self.args.incremental_max_updates:
+                return None
+            return key, num_new, num_updates
+        return None
+
+    def readapt(self, user_id, product_ids, ratings, previous):
+        '''
+            warm-started adaptation from the cached parameters of a prefix of the history
+        '''
+        previous_key, num_new, num_updates = previous
+        names_weights_copy = self.cache.get(previous_key, self.meta_weights)
+        support, task_info = self.task_builder.make_incremental_support(
+            user_id, product_ids, ratings, num_new, normalized=self.maml.normalize_loss, rng=self.rng)
+        if self.maml.trim_padding:
+            support, _, task_info = trim_task((support, None, task_info))
+        names_weights_copy = self.maml.adapt(support, task_info, names_weights_copy=names_weights_copy,
+                                             num_steps=self.args.incremental_steps)
+        # the prefix will not be requested again
+        self.cache.remove(previous_key)
+        return names_weights_copy, num_updates + 1
+
+    def adapt_task(self, user_id, product_ids, ratings, support, task_info):
+        '''
+            cached adapted parameters of the history, warm-started from a cached prefix
+            or adapted to the support set on a cache miss
+        '''
+        key = history_fingerprint(user_id, product_ids, ratings)
+        names_weights_copy = self.cache.get(key, self.meta_weights)
+        if names_weights_copy is not None:
+            return names_weights_copy
+        previous = self.previous_history(user_id, product_ids, ratings)
+        if previous is None:
+            names_weights_copy, num_updates = self.maml.adapt(
+                support, task_info), 0
+        else:
+            names_weights_copy, num_updates = self.readapt(
+                user_id, product_ids, ratings, previous)
+        self.cache.put(key, self.meta_weights,
+                       names_weights_copy, num_updates)
+        return names_weights_copy
+
+    def predict(self, product_ids, ratings, target_product_ids, user_id=0):
+        '''
+        predict ratings of a user
+
+        Args:
+            product_ids : rated product history (oldest first)
+            ratings : ratings of the history
+            target_product_ids : products to predict ratings for
+            user_id : user id (0 for users outside the training data)
+        return:
+            predictions : predicted rating of each target product
+        '''
+        self.refresh()
+        support, query, task_info = self.make_task(
+            product_ids, ratings, target_product_ids, user_id)
+        names_weights_copy = self.adapt_task(
+            user_id, product_ids, ratings, support, task_info)
+        query_inputs = tuple(x.to(self.device) for x in query[:4])
+        return self.maml.predict(query_inputs, names_weights_copy).cpu().numpy()
+
+    def history_state(self, product_ids, ratings, user_id=0):
+        '''
+        adapted parameters and the model's encoded history, for models with
+        incremental inference (encode_history / score_targets)
+
+        states are cached per history (up to weight_cache_size users), the cache is
+        cleared when the checkpoint changes
+        return:
+            state : dict with the history, its adapted parameters and the encoded history
+        '''
+        model = self.maml.model
+        if not hasattr(model, 'encode_history'):
+            raise ValueError(
+                f'{self.args.model} has no incremental inference')
+        self.refresh()
+        key = history_fingerprint(user_id, product_ids, ratings)
+        if key in self.states:
+            self.states.move_to_end(key)
+            return self.states[key]
+
+        support, query, task_info = self.make_task(
+            product_ids, ratings, [0], user_id)
+        names_weights_copy = self.adapt_task(
+            user_id, product_ids, ratings, support, task_info)
+        query_inputs = tuple(x.to(self.device) for x in query[:4])
+        with torch.no_grad():
+            encoded = model.encode_history(
+                query_inputs, params=names_weights_copy)
+        state = {'user_id': user_id, 'product_ids': list(product_ids), 'ratings': list(ratings),
+                 'params': names_weights_copy, 'encoded': encoded}
+        self.store_state(key, state)
+        return state
+
+    def append(self, state, product_ids, ratings):
+        '''
+        state of the history of state followed by new interactions, with the
+        parameters of state (no re-adaptation, use history_state to re-adapt)
+
+        models with append_history (GRU4REC, NARM) advance their hidden state by one
+        step per interaction when this equals encoding the longer history: with
+        --trim_padding and while the history fits in the query window. Otherwise,
+        and for the other models (SASRec, whose positions shift when an interaction
+        is appended), the history is encoded again.
+        appended states are not added to the state cache, they keep the parameters
+        adapted to the shorter history
+        '''
+        model = self.maml.model
+        state = dict(state, product_ids=state['product_ids'] + list(product_ids),
+                     ratings=state['ratings'] + list(ratings))
+        history_len = self.task_builder.max_sequence_length - 1
+        with torch.no_grad():
+            if hasattr(model, 'append_history') and model.skip_padding \
+                    and len(state['product_ids']) <= history_len:
+                new_product_ids = torch.LongTensor(
+                    list(product_ids)).view(1, -1).to(self.device)
+                state['encoded'] = model.append_history(
+                    state['encoded'], new_product_ids, params=state['params'])
+            else:
+                _, query, _ = self.make_task(
+                    state['product_ids'], state['ratings'], [0], state['user_id'])
+                query_inputs = tuple(x.to(self.device) for x in query[:4])
+                state['encoded'] = model.encode_history(
+                    query_inputs, params=state['params'])
+        return state
+
+    def store_state(self, key, state):
+        self.states[key] = state
+        while len(self.states) > self.args.weight_cache_size:
+            self.states.popitem(last=False)
+
+    def score(self, state, target_product_ids):
+        '''
+            predicted ratings of target products after the history of state (history_state or append)
+        '''
+        target_product_id = torch.LongTensor(
+            target_product_ids).view(-1, 1).to(self.device)
+        with torch.no_grad():
+            predictions = self.maml.model.score_targets(
+                state['encoded'], target_product_id, params=state['params'])
+        if self.maml.normalize_loss:
+            predictions = predictions * 5.0
+        return predictions.cpu().numpy()
+
+    def predict_batch(self, requests):
+        '''
+        predict ratings of several users, adapting the uncached ones in one adapt_batch call
+
+        Args:
+            requests : list of dicts with product_ids, ratings, target_product_ids and optional user_id
+        return:
+            results : predictions of each request, or the ValueError raised for invalid requests
+        '''
+        self.refresh()
+        results = [None] * len(requests)
+        tasks = []
+        misses = []
+        for idx, request in enumerate(requests):
+            user_id = request.get('user_id', 0)
+            product_ids, ratings = request['product_ids'], request['ratings']
+            try:
+                task = self.make_task(
+                    product_ids, ratings, request['target_product_ids'], user_id)
+                key = history_fingerprint(user_id, product_ids, ratings)
+                names_weights_copy = self.cache.get(key, self.meta_weights)
+                if names_weights_copy is None:
+                    previous = self.previous_history(
+                        user_id, product_ids, ratings)
+                    if previous is None:
+                        misses.append(len(tasks))
+                    else:
+                        names_weights_copy, num_updates = self.readapt(
+                            user_id, product_ids, ratings, previous)
+                        self.cache.put(key, self.meta_weights,
+                                       names_weights_copy, num_updates)
+            except ValueError as e:
+                results[idx] = e
+                continue
+            tasks.append([idx, key, task, names_weights_copy])
+        if len(tasks) == 0:
+            return results
+
+        # users without cached weights are adapted from scratch together
+        if misses:
+            task_weights = self.maml.adapt_batch(
+                [(tasks[i][2][0], tasks[i][2][2]) for i in misses])
+            for i, names_weights_copy in zip(misses, task_weights):
+                self.cache.put(tasks[i][1], self.meta_weights,
+                               names_weights_copy)
+                tasks[i][3] = names_weights_copy
+
+        for idx, _, (_, query, _), names_weights_copy in tasks:
+            query_inputs = tuple(x.to(self.device) for x in query[:4])
+            results[idx] = self.maml.predict(
+                query_inputs, names_weights_copy).cpu().numpy()
+        return results
+
+
+def main(args):
+    '''
+        predict ratings of one user from the command line
+        --history "item:rating,item:rating,..." --targets "item,item,..."
+    '''
+    predictor = Predictor(args, args.checkpoint_step, args.test_best)
+    history = [pair.split(':') for pair in args.history.split(',')]
+    product_ids = [int(item) for item, _ in history]
+    ratings = [float(rating) for _, rating in history]
+    target_product_ids = [int(item) for item in args.targets.split(',')]
+    predictions = predictor.predict(product_ids, ratings, target_product_ids)
+    for product_id, rating in zip(target_product_ids, predictions):
+        print(f'{product_id}\t{rating:.4f}')
+
+
+if __name__ == '__main__':
+    main(parse_args())
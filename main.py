@@ -1,17 +1,20 @@
 from models import model_factory
 from models.meta_loss_model import MetaLossNetwork, MetaTaskMLPNetwork, MetaTaskLstmNetwork
 from inner_loop_optimizers import LSLRGradientDescentLearningRule
-from dataloader import DataLoader
-from options import args
-import math
-import wandb
+from dataloader import DataLoader, trim_task
+from task_store import load_task_store
+from checkpoint import CheckpointWriter, bind_state_dict, load_checkpoint, load_state_dict_file, resolve_checkpoint
+from metrics import make_metrics_sink
+from profiling import PhaseTimer, MemoryProfiler, format_breakdown, make_profiler
+from options import parse_args
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import itertools
 import os
+import time
 import numpy as np
-from tqdm import tqdm
 # from torch.utils.tensorboard import SummaryWriter
 
 
@@ -21,7 +24,14 @@ VAL_INTERVAL = 50
 
 
 class MAML:
-    def __init__(self, args):
+    def __init__(self, args, load_data=True, training=True):
+        '''
+            Args:
+                load_data : preprocess the dataset, without it args.num_users and
+                            args.num_items must already be set (evaluation on frozen tasks)
+                training : create optimizers, schedulers, checkpoint writer and metrics sink,
+                           without it the model can only be loaded and used for inference
+        '''
 
         self.args = args
         self.batch_size = args.batch_size  # task batch size
@@ -30,11 +40,14 @@ class MAML:
         self.val_log_interval = args.log_interval
 
         # load dataloader
-        self.dataloader = DataLoader(args, pretraining=False)
+        if load_data:
+            self.dataloader = DataLoader(args, pretraining=False)
 
-        # set # of users and # of items
-        self.args.num_users = self.dataloader.num_users
-        self.args.num_items = self.dataloader.num_items
+            # set # of users and # of items
+            self.args.num_users = self.dataloader.num_users
+            self.args.num_items = self.dataloader.num_items
+        else:
+            self.dataloader = None
 
         # set device
         self.device = torch.device('cpu')
@@ -52,12 +65,29 @@ class MAML:
         self._embedding_dir = os.path.join(args.pretrain_log_dir, 'embedding')
         self._pretrained_dir = os.path.join(
             args.pretrain_log_dir, 'pretrained')
-        os.makedirs(self._log_dir, exist_ok=True)
-        os.makedirs(self._save_dir, exist_ok=True)
-
-        if args.load_pretrained_embedding:
+        self.training = training
+        if training:
+            os.makedirs(self._log_dir, exist_ok=True)
+            os.makedirs(self._save_dir, exist_ok=True)
+
+            # background checkpoint writer with retention policy
+            self.checkpoint_writer = CheckpointWriter(
+                self._save_dir, prefix=f"{args.model}_", suffix=f"_{args.mode}_{args.model}.ckpt",
+                keep_last=args.keep_last_checkpoints, keep_best=args.keep_best_checkpoints,
+                async_write=args.async_checkpoint)
+
+            # metrics sink (local files by default, wandb/tensorboard optional)
+            self.metrics = make_metrics_sink(args, self._log_dir)
+
+        # per-phase timing of meta-training iterations
+        self.timer = PhaseTimer(enabled=args.profile_phases or args.profile_trace_dir is not None,
+                                window=args.profile_window, sync=args.profile_sync,
+                                record_functions=args.profile_trace_dir is not None)
+
+        # inference models are loaded from a meta-trained checkpoint instead
+        if training and args.load_pretrained_embedding:
             self._load_pretrained_embedding()
-        elif args.load_pretrained:
+        elif training and args.load_pretrained:
             self._load_pretrained()
 
         # MAML++ multi-step updates
@@ -82,18 +112,19 @@ class MAML:
             names_weights_dict=self.get_inner_loop_parameter_dict(params=self.model.named_parameters()))
 
         # optimizer for inner loop lr
-        if self._use_learnable_params:
+        if self._use_learnable_params and training:
             self._learning_lr = args.learn_lr
             self.lr_optimizer = optim.Adam(
                 self.inner_loop_optimizer.parameters(), lr=self._learning_lr)
 
-        # meta model optimizer
-        self.meta_optimizer = optim.Adam(
-            self.model.parameters(), lr=self._outer_lr)
+        if training:
+            # meta model optimizer
+            self.meta_optimizer = optim.Adam(
+                self.model.parameters(), lr=self._outer_lr)
 
-        # meta learning rate scheduler (cosine annealing scheduler)
-        self.meta_lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(
-            self.meta_optimizer, T_max=args.num_train_iterations, eta_min=args.min_outer_lr)
+            # meta learning rate scheduler (cosine annealing scheduler)
+            self.meta_lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(
+                self.meta_optimizer, T_max=args.num_train_iterations, eta_min=args.min_outer_lr)
 
         # current epoch
         self._train_step = 0
@@ -112,11 +143,12 @@ class MAML:
             num_loss_dims = args.max_seq_len
             self.loss_network = MetaLossNetwork(
                 self._num_inner_steps, num_loss_dims, args.loss_num_layers, use_step_loss=args.use_step_loss).to(self.device)
-            self.loss_optimizer = optim.Adam(
-                self.loss_network.parameters(), lr=self._loss_lr, weight_decay=args.loss_weight_decay)
-            self.loss_lr_scheduler = optim.lr_scheduler.\
-                MultiStepLR(self.loss_optimizer, milestones=[
-                            500, 1000, 1500], gamma=0.7)
+            if training:
+                self.loss_optimizer = optim.Adam(
+                    self.loss_network.parameters(), lr=self._loss_lr, weight_decay=args.loss_weight_decay)
+                self.loss_lr_scheduler = optim.lr_scheduler.\
+                    MultiStepLR(self.loss_optimizer, milestones=[
+                                500, 1000, 1500], gamma=0.7)
 
         # STATS network
         # loss, mean, std, labels, and predictions are included for statistical information
@@ -128,11 +160,12 @@ class MAML:
             self._task_info_lr = args.task_info_lr
             self.task_info_network = MetaTaskMLPNetwork(
                 num_loss_weight_dims, use_softmax=args.use_softmax).to(self.device)
-            self.task_info_optimizer = optim.Adam(
-                self.task_info_network.parameters(), lr=self._task_info_lr)
-            self.task_info_lr_scheduler = optim.lr_scheduler.\
-                MultiStepLR(self.task_info_optimizer, milestones=[
-                            500, 1000, 1500], gamma=0.7)
+            if training:
+                self.task_info_optimizer = optim.Adam(
+                    self.task_info_network.parameters(), lr=self._task_info_lr)
+                self.task_info_lr_scheduler = optim.lr_scheduler.\
+                    MultiStepLR(self.task_info_optimizer, milestones=[
+                                500, 1000, 1500], gamma=0.7)
 
         # lstm loss network
         if self.use_lstm:
@@ -140,19 +173,38 @@ class MAML:
             lstm_hidden = args.lstm_hidden
             self.task_lstm_network = MetaTaskLstmNetwork(
                 input_size=args.lstm_input_size, lstm_hidden=lstm_hidden, num_lstm_layers=args.lstm_num_layers, lstm_out=0, device=self.device, use_softmax=args.use_softmax).to(self.device)
-            self.task_lstm_optimizer = optim.Adam(
-                self.task_lstm_network.parameters(), lr=self._lstm_lr)
-            self.lstm_lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(
-                self.task_lstm_optimizer, T_max=args.num_train_iterations, eta_min=1e-2)
+            if training:
+                self.task_lstm_optimizer = optim.Adam(
+                    self.task_lstm_network.parameters(), lr=self._lstm_lr)
+                self.lstm_lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(
+                    self.task_lstm_optimizer, T_max=args.num_train_iterations, eta_min=1e-2)
 
         self.use_mlp_mean = args.use_mlp_mean
 
-        self.rating_info = {}
-        for i in range(1,6):
-            self.rating_info['rating_'+str(i)] = {}
-            self.rating_info['rating_'+str(i)]['loss'] = []
-            self.rating_info['rating_'+str(i)]['pred'] = []
-            self.rating_info['rating_'+str(i)]['num'] = []
+        # trim padding columns of each task
+        self.trim_padding = args.trim_padding
+        # the mlp mean loss network takes exactly max_seq_len losses
+        uses_loss_network = self.use_mlp_mean or not (
+            self.use_lstm or self.use_adaptive_loss_weight)
+        if self.trim_padding and self.use_adaptive_loss and uses_loss_network:
+            raise ValueError(
+                'trim_padding can not be used with the mlp mean loss network')
+        # sasrec has no key padding mask and attends over padding, trimming it would change the model
+        if self.trim_padding and args.model == 'sasrec':
+            raise ValueError('trim_padding can not be used with sasrec')
+
+        self.reset_rating_info()
+
+        # memory of retained inner loop graphs, attributed to these modules
+        profiled_modules = {'model': self.model}
+        if self.use_adaptive_loss:
+            profiled_modules['loss_network'] = self.loss_network
+        if self.use_adaptive_loss_weight:
+            profiled_modules['task_info_network'] = self.task_info_network
+        if self.use_lstm:
+            profiled_modules['lstm_network'] = self.task_lstm_network
+        self.memory_profiler = MemoryProfiler(
+            enabled=args.profile_memory, modules=profiled_modules)
 
         # best results
         self.best_step = 0
@@ -160,6 +212,14 @@ class MAML:
 
         print("Finished initialization")
 
+    def reset_rating_info(self):
+        self.rating_info = {}
+        for i in range(1,6):
+            self.rating_info['rating_'+str(i)] = {}
+            self.rating_info['rating_'+str(i)]['loss'] = []
+            self.rating_info['rating_'+str(i)]['pred'] = []
+            self.rating_info['rating_'+str(i)]['num'] = []
+
     # per step loss weight for multi step loss function
     def get_per_step_loss_importance_vector(self):
         """
@@ -211,12 +271,14 @@ class MAML:
 
         self.model.zero_grad(params=names_weights_copy)
 
-        grads = torch.autograd.grad(loss, names_weights_copy.values(),
-                                    allow_unused=True, create_graph=use_second_order)
+        with self.timer.phase('inner_grad'), self.memory_profiler.component('inner_grad'):
+            grads = torch.autograd.grad(loss, names_weights_copy.values(),
+                                        allow_unused=True, create_graph=use_second_order)
         names_grads_copy = dict(zip(names_weights_copy.keys(), grads))
 
-        names_weights_copy = self.inner_loop_optimizer.update_params(names_weights_dict=names_weights_copy,
-                                                                     names_grads_wrt_params_dict=names_grads_copy, num_step=step)
+        with self.timer.phase('lslr_update'), self.memory_profiler.component('lslr_update'):
+            names_weights_copy = self.inner_loop_optimizer.update_params(names_weights_dict=names_weights_copy,
+                                                                         names_grads_wrt_params_dict=names_grads_copy, num_step=step)
 
         return names_weights_copy
 
@@ -225,6 +287,9 @@ class MAML:
         """
         reset all gradients of meta paramters
         """
+        # evaluation only models have no optimizers and never accumulate gradients
+        if not self.training:
+            return
         # initialize meta parameters
         self.meta_optimizer.zero_grad()
         if self.use_adaptive_loss:
@@ -241,23 +306,25 @@ class MAML:
         update all meta paramters
         :param mse_loss: meta mse loss
         """
-        mse_loss.backward()
-        torch.nn.utils.clip_grad_norm_(
-            self.model.parameters(), max_norm=5.0)
-
-        self.meta_optimizer.step()
-        self.meta_lr_scheduler.step()
-        if self.use_adaptive_loss and self.use_mlp_mean:
-            self.loss_optimizer.step()
-        if self.use_lstm:
+        with self.timer.phase('meta_backward'):
+            mse_loss.backward()
+            torch.nn.utils.clip_grad_norm_(
+                self.model.parameters(), max_norm=5.0)
+
+        with self.timer.phase('optimizer_step'):
+            self.meta_optimizer.step()
+            self.meta_lr_scheduler.step()
+            if self.use_adaptive_loss and self.use_mlp_mean:
+                self.loss_optimizer.step()
+            if self.use_lstm:
 
-            self.task_lstm_optimizer.step()
-            self.lstm_lr_scheduler.step()
-        if self.use_adaptive_loss_weight:
-            self.task_info_optimizer.step()
-            # self.task_info_lr_scheduler.step()
-        if self._use_learnable_params:
-            self.lr_optimizer.step()
+                self.task_lstm_optimizer.step()
+                self.lstm_lr_scheduler.step()
+            if self.use_adaptive_loss_weight:
+                self.task_info_optimizer.step()
+                # self.task_info_lr_scheduler.step()
+            if self._use_learnable_params:
+                self.lr_optimizer.step()
 
         # forward on query data
 
@@ -377,6 +444,156 @@ class MAML:
         """
         return torch.pow(torch.abs(y-x), ord)
 
+    def inner_loss_fn(self):
+        # option for focal loss
+        if self.use_focal_loss:
+            return self.focal_loss
+        return nn.MSELoss(reduction='none')
+
+    def support_to_device(self, support_data, task_info):
+        '''
+            move support data and task information to device
+            return:
+                inputs, target_rating, task_info
+        '''
+        with self.timer.phase('h2d'):
+            user_id, product_history, target_product_id,  product_history_ratings, target_rating = support_data
+            inputs = user_id.to(self.device), product_history.to(
+                self.device), \
+                target_product_id.to(
+                    self.device),  product_history_ratings.to(self.device)
+            task_info = task_info.to(self.device)
+
+            target_rating = target_rating.to(self.device)
+        return inputs, target_rating, task_info
+
+    def support_loss(self, inputs, target_rating, task_info, names_weights_copy, step, loss_fn):
+        '''
+            (adaptive) inner loop loss on support set with parameters names_weights_copy
+        '''
+        # forward propagate on support set
+        with self.timer.phase('support_forward'):
+            outputs = self.model(inputs, params=names_weights_copy)
+            gt = torch.cat(
+                (inputs[3], target_rating), dim=1)
+            mask = (gt != 0)
+            # compute mse loss
+            if self.normalize_loss:
+                loss = loss_fn(outputs*mask, gt*mask/5.0)
+            else:
+                loss = loss_fn(outputs*mask, gt*mask)
+
+        # adaptive weighted loss
+        if self.use_adaptive_loss:
+            with self.timer.phase('adaptive_loss'):
+                if self.task_info_predictions:
+                    task_info_f = torch.cat(
+                        (task_info, outputs.unsqueeze(2)), dim=2)
+                else:
+                    task_info_f = task_info
+                loss = self.compute_adaptive_loss(
+                    loss, inputs, target_rating, step, mask, task_info_f)
+
+        # normal mse loss
+        else:
+            loss = loss.sum()/mask.sum()
+        return loss
+
+    def inner_step(self, inputs, target_rating, task_info, names_weights_copy, step, loss_fn, use_second_order=True):
+        '''
+            one inner loop update of names_weights_copy with the learned per-step learning rates
+        '''
+        loss = self.support_loss(
+            inputs, target_rating, task_info, names_weights_copy, step, loss_fn)
+        names_weights_copy = self.apply_inner_loop_update(
+            loss=loss, names_weights_copy=names_weights_copy, use_second_order=use_second_order, step=step)
+        self.memory_profiler.record_step(step, loss, names_weights_copy)
+        return names_weights_copy
+
+    def adapt(self, support_data, task_info, use_second_order=False, names_weights_copy=None, num_steps=None):
+        '''
+        adapt meta parameters to a task (inner loop without query set)
+
+        Args:
+            support_data : support set of the task
+            task_info : task information of the task
+            use_second_order : keep the graph for meta gradients (not needed for inference)
+            names_weights_copy : start from these (previously adapted) parameters instead of the meta parameters
+            num_steps : run only the last num_steps inner steps (learning rates and loss networks of those steps)
+        return:
+            names_weights_copy : adapted parameters, usable as params of self.model
+        '''
+        loss_fn = self.inner_loss_fn()
+        if names_weights_copy is None:
+            names_weights_copy = self.get_inner_loop_parameter_dict(
+                self.model.named_parameters())
+        else:
+            names_weights_copy = {name: weight.detach().requires_grad_()
+                                  for name, weight in names_weights_copy.items()}
+        if num_steps is None:
+            num_steps = self._num_inner_steps
+        inputs, target_rating, task_info = self.support_to_device(
+            support_data, task_info)
+        for step in range(self._num_inner_steps - min(num_steps, self._num_inner_steps), self._num_inner_steps):
+            names_weights_copy = self.inner_step(
+                inputs, target_rating, task_info, names_weights_copy, step, loss_fn, use_second_order)
+        return names_weights_copy
+
+    def adapt_batch(self, task_batch, use_second_order=False):
+        '''
+        adapt meta parameters to several tasks in one call
+
+        this is not a vectorized adaptation: forward passes still run per task and the
+        backward work equals one autograd.grad call per task. only the per-step autograd
+        call is shared (one call on the summed support losses, each task has its own
+        fast weights so the gradient of the sum wrt them is the gradient of its own
+        loss), which saves python and autograd call overhead (benchmark.py adapt_batch)
+
+        Args:
+            task_batch : list of (support_data, task_info)
+            use_second_order : keep the graph for meta gradients
+        return:
+            adapted parameters of each task
+        '''
+        loss_fn = self.inner_loss_fn()
+        names_weights = self.get_inner_loop_parameter_dict(
+            self.model.named_parameters())
+        tasks = [self.support_to_device(support_data, task_info)
+                 for support_data, task_info in task_batch]
+        # views make the weights of each task separate graph nodes without copying
+        task_weights = [{name: weight.view_as(weight) for name, weight in names_weights.items()}
+                        for _ in tasks]
+
+        for step in range(self._num_inner_steps):
+            losses = [self.support_loss(inputs, target_rating, task_info, names_weights_copy, step, loss_fn)
+                      for (inputs, target_rating, task_info), names_weights_copy in zip(tasks, task_weights)]
+            weights = [weight for names_weights_copy in task_weights
+                       for weight in names_weights_copy.values()]
+            with self.timer.phase('inner_grad'):
+                grads = torch.autograd.grad(torch.stack(losses).sum(), weights,
+                                            allow_unused=True, create_graph=use_second_order)
+            with self.timer.phase('lslr_update'):
+                num_weights = len(names_weights)
+                for idx, names_weights_copy in enumerate(task_weights):
+                    task_grads = grads[idx * num_weights:(idx + 1) * num_weights]
+                    task_weights[idx] = self.inner_loop_optimizer.update_params(
+                        names_weights_dict=names_weights_copy,
+                        names_grads_wrt_params_dict=dict(
+                            zip(names_weights_copy.keys(), task_grads)),
+                        num_step=step)
+        return task_weights
+
+    def predict(self, query_inputs, names_weights_copy):
+        '''
+            predicted ratings of the query targets with (adapted) parameters
+        '''
+        with torch.no_grad():
+            outputs = self.model(query_inputs, params=names_weights_copy)
+        predictions = outputs[:, -1]
+        if self.normalize_loss:
+            predictions = predictions * 5.0
+        return predictions
+
     # inner loop optimization
     def _inner_loop(self, support_data, task_info, query_inputs, query_target_rating, train):
         """Computes the adapted network parameters via the MAML inner loop.
@@ -396,12 +613,7 @@ class MAML:
 
         # loss functions
         mae_loss_fn = nn.L1Loss()
-
-        # option for focal loss
-        if self.use_focal_loss:
-            loss_fn = self.focal_loss
-        else:
-            loss_fn = nn.MSELoss(reduction='none')
+        loss_fn = self.inner_loss_fn()
 
         task_mse_losses = []
         task_mse_out_losses = []
@@ -414,51 +626,21 @@ class MAML:
         imp_vecs = self.get_per_step_loss_importance_vector()
 
         # GPU enabling
-        user_id, product_history, target_product_id,  product_history_ratings, target_rating = support_data
-        inputs = user_id.to(self.device), product_history.to(
-            self.device), \
-            target_product_id.to(
-                self.device),  product_history_ratings.to(self.device)
-        task_info = task_info.to(self.device)
-
-        target_rating = target_rating.to(self.device)
+        inputs, target_rating, task_info = self.support_to_device(
+            support_data, task_info)
 
         # inner loop optimization
         for step in range(self._num_inner_steps):
 
-            # forward propagate on support set
-            outputs = self.model(inputs, params=names_weights_copy)
-            gt = torch.cat(
-                (inputs[3], target_rating), dim=1)
-            mask = (gt != 0)
-            # compute mse loss
-            if self.normalize_loss:
-                loss = loss_fn(outputs*mask, gt*mask/5.0)
-            else:
-                loss = loss_fn(outputs*mask, gt*mask)
-
-            # adaptive weighted loss
-            if self.use_adaptive_loss:
-                if self.task_info_predictions:
-                    task_info_f = torch.cat(
-                        (task_info, outputs.unsqueeze(2)), dim=2)
-                else:
-                    task_info_f = task_info
-                loss = self.compute_adaptive_loss(
-                    loss, inputs, target_rating, step, mask, task_info_f)
-
-            # normal mse loss
-            else:
-                loss = loss.sum()/mask.sum()
-
             # update inner loop paramters phi
-            names_weights_copy = self.apply_inner_loop_update(
-                loss=loss, names_weights_copy=names_weights_copy, use_second_order=True, step=step)
+            names_weights_copy = self.inner_step(
+                inputs, target_rating, task_info, names_weights_copy, step, loss_fn, use_second_order=True)
 
             ##### multi step loss - update meta paramters ######
             if self.use_multi_step and self._train_step < self.args.multi_step_loss_num_epochs and train:
-                query_loss, query_out_loss, mae_loss = self.query_forward(
-                    query_inputs, query_target_rating, names_weights_copy, mae_loss_fn, imp_vecs[step], train)
+                with self.timer.phase('query_forward'):
+                    query_loss, query_out_loss, mae_loss = self.query_forward(
+                        query_inputs, query_target_rating, names_weights_copy, mae_loss_fn, imp_vecs[step], train)
                 task_mse_losses.append(query_loss)
                 task_mse_out_losses.append(query_out_loss)
                 task_mae_losses.append(mae_loss)
@@ -469,8 +651,9 @@ class MAML:
                 # at last step
                 if step == self._num_inner_steps - 1:
 
-                    query_loss, query_out_loss, mae_loss = self.query_forward(
-                        query_inputs, query_target_rating, names_weights_copy, mae_loss_fn, train)
+                    with self.timer.phase('query_forward'):
+                        query_loss, query_out_loss, mae_loss = self.query_forward(
+                            query_inputs, query_target_rating, names_weights_copy, mae_loss_fn, train)
                     task_mse_losses.append(query_loss)
                     task_mse_out_losses.append(query_out_loss)
                     task_mae_losses.append(mae_loss)
@@ -505,20 +688,28 @@ class MAML:
         else:
             self.model.eval()
 
+        from tqdm import tqdm
+
         # loop through task batch
         for idx, task in enumerate(tqdm(task_batch)):
+            if self.trim_padding:
+                task = trim_task(task)
+
             # query data gpu loading
             support, query, task_info = task
-            user_id, product_history, target_product_id,  product_history_ratings, target_rating = query
-            query_inputs = user_id.to(self.device), product_history.to(
-                self.device), \
-                target_product_id.to(
-                    self.device),  product_history_ratings.to(self.device)
-            query_target_rating = target_rating.to(self.device)
+            with self.timer.phase('h2d'):
+                user_id, product_history, target_product_id,  product_history_ratings, target_rating = query
+                query_inputs = user_id.to(self.device), product_history.to(
+                    self.device), \
+                    target_product_id.to(
+                        self.device),  product_history_ratings.to(self.device)
+                query_target_rating = target_rating.to(self.device)
 
             # inner loop operation
+            self.memory_profiler.start_task(idx)
             query_loss, query_out_loss, mae_loss = self._inner_loop(
                 support, task_info, query_inputs, query_target_rating, train)  # do inner loop
+            self.memory_profiler.end_task(query_loss)
 
             # collect loss data
             mse_loss_batch.append(query_loss)
@@ -548,83 +739,124 @@ class MAML:
         """
         print(f"Starting MAML training at iteration {self._train_step}")
 
-        # initialize wandb project
+        # initialize metrics run
         if self.use_adaptive_loss:
-            wandb.init(
-                project=f"MELO-TRAIN-{self.args.model}-{self.args.mode}")
+            self.metrics.init(
+                f"MELO-TRAIN-{self.args.model}-{self.args.mode}", self.args)
         else:
-            wandb.init(
-                project=f"MAML-TRAIN-{self.args.model}-{self.args.mode}")
+            self.metrics.init(
+                f"MAML-TRAIN-{self.args.model}-{self.args.mode}", self.args)
 
-        # define tensorboard writer and wandb config
-        # # writer = SummaryWriter(log_dir=self._log_dir)
-        wandb.config.update(self.args)
-
-        val_batches = self.dataloader.generate_task(
-            mode="valid", batch_size=self.val_size, normalized=self.normalize_loss, use_label=self.args.use_label)
+        # torch.profiler trace of a few iterations
+        profiler = None
+        if self.args.profile_trace_dir is not None:
+            profiler = make_profiler(
+                self.args.profile_trace_dir, self.args.profile_trace_steps)
+            profiler.start()
 
         start_point = self._train_step+1
         # iteration
-        for i in range(start_point, train_steps+1):
-            self._train_step += 1
-
-            # generate train task batch
-            train_task = self.dataloader.generate_task(
-                mode="train", batch_size=self.batch_size, normalized=self.normalize_loss, use_label=self.args.use_label)
-
-            # update meta paramters and return losses
-            mse_loss, rmse_loss, mae_loss = self._outer_loop(
-                train_task, train=True)
-
-            # looging
-            if i % LOG_INTERVAL == 0:
-                print(
-                    f'Iteration {self._train_step}: '
-                    f'MSE loss: {mse_loss:.4f} | '
-                    f'RMSE loss: {rmse_loss:.4f} | '
-                    f'MAE loss: {mae_loss:.4f} | '
-                )
-                # writer.add_scalar("train/MSEloss", mse_loss, self._train_step)
-                # writer.add_scalar("train/RMSEloss",
-                                #   rmse_loss, self._train_step)
-                # writer.add_scalar("train/MAEloss", mae_loss, self._train_step)
-
-            # evaluate validation set
-            if i % self.val_log_interval == 0:
-                # set validation tasks
-                val_mse_losses = []
-                val_mae_losses = []
-                for j in range(math.ceil(len(val_batches)/self.batch_size)):
-                    mse_loss, _, mae_loss = self._outer_loop(
-                        val_batches[j*self.batch_size: (j+1)*self.batch_size], train=False)
-                    val_mse_losses.append(mse_loss)
-                    val_mae_losses.append(mae_loss)
-
-                mse_loss = np.mean(val_mse_losses)
-                rmse_loss = np.sqrt(mse_loss)
-                mae_loss = np.mean(val_mae_losses)
-
-                print(
-                    f'\tValidation: '
-                    f'Val MSE loss: {mse_loss:.4f} | '
-                    f'Val RMSE loss: {rmse_loss:.4f} | '
-                    f'Val MAE loss: {mae_loss:.4f} | '
-                )
-                wandb.log({"loss": rmse_loss})
-                self._save_model(best=False)
-                # Save the best model wrt valid rmse loss
-                if self.best_valid_rmse_loss > rmse_loss:
-                    self.best_valid_rmse_loss = rmse_loss
-                    self.best_step = i
-                    self._save_model()
+        try:
+            for i in range(start_point, train_steps+1):
+                self._train_step += 1
+
+                # generate train task batch
+                data_start = time.perf_counter()
+                with self.timer.phase('task_generation'):
+                    train_task = self.dataloader.generate_task(
+                        mode="train", batch_size=self.batch_size, normalized=self.normalize_loss, use_label=self.args.use_label)
+
+                # update meta paramters and return losses
+                step_start = time.perf_counter()
+                profile_memory = i < start_point + self.args.profile_memory_steps
+                with self.memory_profiler.track(profile_memory):
+                    mse_loss, rmse_loss, mae_loss = self._outer_loop(
+                        train_task, train=True)
+                step_end = time.perf_counter()
+                if self.memory_profiler.enabled and profile_memory:
+                    print(self.memory_profiler.summary())
+                    self.memory_profiler.reset()
+                breakdown = self.timer.end_iteration()
+                if profiler is not None:
+                    profiler.step()
+
+                # looging
+                if i % LOG_INTERVAL == 0:
                     print(
-                        f'........Model saved (step: {self.best_step} | RMSE loss: {rmse_loss:.4f})')
+                        f'Iteration {self._train_step}: '
+                        f'MSE loss: {mse_loss:.4f} | '
+                        f'RMSE loss: {rmse_loss:.4f} | '
+                        f'MAE loss: {mae_loss:.4f} | '
+                    )
+                    step_time = step_end - step_start
+                    self.metrics.log({
+                        "train/mse_loss": mse_loss,
+                        "train/rmse_loss": rmse_loss,
+                        "train/mae_loss": mae_loss,
+                        "train/tasks_per_s": len(train_task) / step_time,
+                        "train/inner_steps_per_s": len(train_task) * self._num_inner_steps / step_time,
+                        "train/data_ms": (step_start - data_start) * 1000,
+                        "train/outer_loop_ms": step_time * 1000,
+                        **{f"phase/{name}_ms": ms for name, ms in breakdown.items()},
+                    }, step=self._train_step)
+                    if self.timer.enabled:
+                        print(f'\t{format_breakdown(breakdown)}')
+                    # writer.add_scalar("train/MSEloss", mse_loss, self._train_step)
+                    # writer.add_scalar("train/RMSEloss",
+                                    #   rmse_loss, self._train_step)
+                    # writer.add_scalar("train/MAEloss", mae_loss, self._train_step)
+
+                # evaluate validation set
+                if i % self.val_log_interval == 0:
+                    # set validation tasks
+                    valid_start = time.perf_counter()
+                    mse_loss, rmse_loss, mae_loss = self.evaluate(
+                        self.iter_eval_tasks("valid", self.val_size))
+                    valid_time = time.perf_counter() - valid_start
+                    self.timer.discard()
 
-                # writer.add_scalar("valid/MSEloss", mse_loss, self._train_step)
-                # writer.add_scalar("valid/RMSEloss",
-                                #   rmse_loss, self._train_step)
-                # writer.add_scalar("valid/MAEloss", mae_loss, self._train_step)
+                    print(
+                        f'\tValidation: '
+                        f'Val MSE loss: {mse_loss:.4f} | '
+                        f'Val RMSE loss: {rmse_loss:.4f} | '
+                        f'Val MAE loss: {mae_loss:.4f} | '
+                    )
+                    if self.timer.enabled:
+                        print(self.timer.summary())
+                    self.metrics.log({
+                        "loss": rmse_loss,
+                        "valid/mse_loss": mse_loss,
+                        "valid/mae_loss": mae_loss,
+                        "valid/tasks_per_s": self.val_size / valid_time,
+                        "valid/ms": valid_time * 1000,
+                    }, step=self._train_step)
+                    # update best results first so that both checkpoints hold the same training state
+                    is_best = self.best_valid_rmse_loss > rmse_loss
+                    if is_best:
+                        self.best_valid_rmse_loss = rmse_loss
+                        self.best_step = i
+                    self._save_model(best=False)
+                    # Save the best model wrt valid rmse loss
+                    if is_best:
+                        self._save_model()
+                        print(
+                            f'........Model saved (step: {self.best_step} | RMSE loss: {rmse_loss:.4f})')
+
+                    # writer.add_scalar("valid/MSEloss", mse_loss, self._train_step)
+                    # writer.add_scalar("valid/RMSEloss",
+                                    #   rmse_loss, self._train_step)
+                    # writer.add_scalar("valid/MAEloss", mae_loss, self._train_step)
+        finally:
+            # queued checkpoints are still written when training fails
+            self.checkpoint_writer.close()
         # writer.close()
+        self.metrics.close()
+        if profiler is not None:
+            profiler.stop()
+            print('Profiler trace saved to', self.args.profile_trace_dir)
+        if self.timer.enabled:
+            print(f'Phase times over the last {self.timer.window} iterations')
+            print(self.timer.summary())
 
         print("-------------------------------------------------")
         print("Model with the best validation RMSE loss is saved.")
@@ -637,28 +869,18 @@ class MAML:
             Test on test batches
         '''
 
-        # initialize wandb project
+        # initialize metrics run
         if self.use_adaptive_loss:
-            wandb.init(project=f"MELO-TEST-{self.args.model}-{self.args.mode}")
+            self.metrics.init(
+                f"MELO-TEST-{self.args.model}-{self.args.mode}", self.args)
         else:
-            wandb.init(project=f"MAML-TEST-{self.args.model}-{self.args.mode}")
+            self.metrics.init(
+                f"MAML-TEST-{self.args.model}-{self.args.mode}", self.args)
 
-        # define wandb config
-        wandb.config.update(self.args)
-
-        test_batches = self.dataloader.generate_task(
-            mode="test", batch_size=self.args.num_test_data, normalized=self.normalize_loss, use_label=self.args.use_label)
-        test_mse_losses = []
-        test_mae_losses = []
-        for i in range(math.ceil(len(test_batches)/self.batch_size)):
-            mse_loss, _, mae_loss = self._outer_loop(
-                test_batches[i*self.batch_size: (i+1)*self.batch_size], train=False)
-            test_mse_losses.append(mse_loss)
-            test_mae_losses.append(mae_loss)
-
-        mse_loss = np.mean(test_mse_losses)
-        rmse_loss = np.sqrt(mse_loss)
-        mae_loss = np.mean(test_mae_losses)
+        test_start = time.perf_counter()
+        _, rmse_loss, mae_loss = self.evaluate(
+            self.iter_eval_tasks("test", self.args.num_test_data))
+        test_time = time.perf_counter() - test_start
 
         print(
             f'\tTest: '
@@ -673,24 +895,52 @@ class MAML:
             print('Prediction Mean', np.mean((v['pred'])))
             print('Prediction Median', np.median((v['pred'])))
             print('Prediction Std', np.std((v['pred'])))
-        wandb.log({
+        self.metrics.log({
             "Test RMSE loss": rmse_loss,
-            "Test MAE loss": mae_loss
+            "Test MAE loss": mae_loss,
+            "test/tasks_per_s": self.args.num_test_data / test_time,
+            "test/ms": test_time * 1000,
         })
+        self.metrics.close()
+
+    def evaluate(self, task_batches):
+        '''
+            evaluate the current meta parameters
+
+            Args:
+                task_batches : iterable of task batches
+            return:
+                mse_loss, rmse_loss, mae_loss : mean losses over the batches
+        '''
+        mse_losses = []
+        mae_losses = []
+        for task_batch in task_batches:
+            mse_loss, _, mae_loss = self._outer_loop(
+                task_batch, train=False)
+            mse_losses.append(mse_loss)
+            mae_losses.append(mae_loss)
+
+        mse_loss = np.mean(mse_losses)
+        return mse_loss, np.sqrt(mse_loss), np.mean(mae_losses)
 
     def test_baseline(self):
         '''
             Test baseline(using mean)
         '''
 
-        rating_lst = sum(self.dataloader.train_set['rating'].tolist(), [])
+        rating_lst = np.concatenate(self.dataloader.train_set['rating'].tolist())
         mean_rating = np.mean(rating_lst, dtype='float32')
         print(mean_rating)
-        test_batches = self.dataloader.generate_task(
-            mode="test", batch_size=self.args.num_test_data, normalized=self.normalize_loss, use_label=self.args.use_label)
         mse_loss_batch = []
         mae_loss_batch = []
-        for idx, task in enumerate(tqdm(test_batches)):
+        from tqdm import tqdm
+
+        # one progress bar over the tasks of every chunk
+        test_tasks = itertools.chain.from_iterable(
+            self.iter_eval_tasks("test", self.args.num_test_data))
+        num_tasks = min(self.args.num_test_data, len(
+            self.dataloader.get_data_set("test").index))
+        for task in tqdm(test_tasks, total=num_tasks):
             # query data gpu loading
             _, query, _ = task
             _, _, _,  _, target_rating = query
@@ -711,55 +961,156 @@ class MAML:
             f'Test MAE loss: {mae_loss:.4f} | '
         )
 
-    def load(self, checkpoint_step, best=True):
+    def iter_eval_tasks(self, mode, num_tasks):
+        '''
+            iterate over batches of valid or test tasks
+            tasks are read from the frozen task store if enabled, otherwise they are
+            generated lazily (valid tasks with a fixed seed so that every validation
+            uses the same tasks)
+        '''
+        if self.args.use_task_store:
+            store = load_task_store(self.dataloader, self.args, mode, num_tasks,
+                                    normalized=self.normalize_loss, use_label=self.args.use_label)
+            return store.iter_batches(self.batch_size)
+        seed = self.args.random_seed if mode == "valid" else None
+        return self.dataloader.iter_tasks(mode=mode, num_tasks=num_tasks, batch_size=self.batch_size,
+                                          normalized=self.normalize_loss, use_label=self.args.use_label, seed=seed)
+
+    def checkpoint_path(self, checkpoint_step, best=True, ext='.ckpt'):
+        return checkpoint_path(self.args, checkpoint_step, best, ext)
+
+    def load(self, checkpoint_step, best=True, resume=False, training=True):
         '''
             load meta paramters
+            with resume, the whole training state (sampler position, random states,
+            best results, every optimizer and scheduler) is restored as well
+            without training, only the parts needed for evaluation are read
         '''
-        if best:
-            target_path = os.path.join(
-                self._save_dir, f"{self.args.model}_{checkpoint_step}_best_{self.args.mode}_{self.args.model}.pt")
-        else:
-            target_path = os.path.join(
-                self._save_dir, f"{self.args.model}_{checkpoint_step}_{self.args.mode}_{self.args.model}.pt")
+        target_path = self.checkpoint_path(checkpoint_step, best)
+        if not os.path.exists(resolve_checkpoint(target_path)):
+            target_path = self.checkpoint_path(checkpoint_step, best, ext='.pt')
         print("Loading checkpoint from", target_path)
         try:
             if torch.cuda.is_available():
                 def map_location(storage, loc): return storage.cuda()
             else:
                 map_location = 'cpu'
-            checkpoint = torch.load(target_path, map_location=map_location)
-            self.model.load_state_dict(checkpoint['meta_model'])
-            self.meta_lr_scheduler.load_state_dict(
-                checkpoint['meta_model_scheduler'])
-            self.meta_optimizer.load_state_dict(
-                checkpoint['meta_model_optimizer'])
+            training = (training or resume) and self.training
+            checkpoint = load_checkpoint(
+                target_path, training=training, map_location=map_location)
+
+            # evaluation-only models on cpu use the memory-mapped tensors directly (no copy)
+            def load_weights(module, state_dict):
+                if not training and not torch.cuda.is_available():
+                    bind_state_dict(module, state_dict)
+                else:
+                    module.load_state_dict(state_dict)
+
+            load_weights(self.model, checkpoint['meta_model'])
+            if training and 'meta_model_optimizer' in checkpoint:
+                self.meta_lr_scheduler.load_state_dict(
+                    checkpoint['meta_model_scheduler'])
+                self.meta_optimizer.load_state_dict(
+                    checkpoint['meta_model_optimizer'])
             if self.use_adaptive_loss:
-                self.loss_network.load_state_dict(checkpoint['loss_model'])
+                load_weights(self.loss_network, checkpoint['loss_model'])
             if self.use_adaptive_loss_weight:
-                self.task_info_network.load_state_dict(
-                    checkpoint['loss_weight_model'])
+                load_weights(self.task_info_network,
+                             checkpoint['loss_weight_model'])
             if self.use_lstm:
-                self.task_lstm_network.load_state_dict(
-                    checkpoint['lstm_model'])
+                load_weights(self.task_lstm_network,
+                             checkpoint['lstm_model'])
             if self._use_learnable_params:
-                self.inner_loop_optimizer.load_state_dict(
-                    checkpoint['learning_rate']
-                )
+                load_weights(self.inner_loop_optimizer,
+                             checkpoint['learning_rate'])
+            train_state = checkpoint.get('train_state')
 
         except:
             raise ValueError(
                 f'No checkpoint for iteration {checkpoint_step} found.')
 
+        if resume:
+            if train_state is None:
+                print('Checkpoint has no training state, only meta parameters are restored.')
+            else:
+                self.load_train_state(train_state)
+
+    def resume(self):
+        '''
+            resume training from the latest checkpoint in save_dir
+        '''
+        checkpoints = self.checkpoint_writer.checkpoints()
+        if len(checkpoints) == 0:
+            print('No checkpoint to resume from. Training from scratch.')
+            return
+        step, best, _ = max(checkpoints)
+        self._train_step = step
+        self.load(step, best, resume=True)
+        print(f'Resuming training at iteration {self._train_step}')
+
+    def train_state_dict(self):
+        '''
+            training state besides meta parameters, needed to continue a run exactly
+        '''
+        train_state = {
+            'train_step': self._train_step,
+            'best_step': self.best_step,
+            'best_valid_rmse_loss': self.best_valid_rmse_loss,
+            'dataloader': self.dataloader.state_dict(),
+            'numpy_rng': np.random.get_state(),
+            'torch_rng': torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            train_state['cuda_rng'] = torch.cuda.get_rng_state_all()
+        if self.use_adaptive_loss:
+            train_state['loss_optimizer'] = self.loss_optimizer.state_dict()
+            train_state['loss_scheduler'] = self.loss_lr_scheduler.state_dict()
+        if self.use_adaptive_loss_weight:
+            train_state['loss_weight_optimizer'] = self.task_info_optimizer.state_dict()
+            train_state['loss_weight_scheduler'] = self.task_info_lr_scheduler.state_dict()
+        if self.use_lstm:
+            train_state['lstm_optimizer'] = self.task_lstm_optimizer.state_dict()
+            train_state['lstm_scheduler'] = self.lstm_lr_scheduler.state_dict()
+        if self._use_learnable_params:
+            train_state['learning_rate_optimizer'] = self.lr_optimizer.state_dict()
+        return train_state
+
+    def load_train_state(self, train_state):
+        '''
+            restore the state saved by train_state_dict
+        '''
+        self._train_step = train_state['train_step']
+        self.best_step = train_state['best_step']
+        self.best_valid_rmse_loss = train_state['best_valid_rmse_loss']
+        self.dataloader.load_state_dict(train_state['dataloader'])
+        np.random.set_state(train_state['numpy_rng'])
+        torch.set_rng_state(train_state['torch_rng'].cpu())
+        if torch.cuda.is_available() and 'cuda_rng' in train_state:
+            torch.cuda.set_rng_state_all(
+                [state.cpu() for state in train_state['cuda_rng']])
+        if self.use_adaptive_loss:
+            self.loss_optimizer.load_state_dict(train_state['loss_optimizer'])
+            self.loss_lr_scheduler.load_state_dict(
+                train_state['loss_scheduler'])
+        if self.use_adaptive_loss_weight:
+            self.task_info_optimizer.load_state_dict(
+                train_state['loss_weight_optimizer'])
+            self.task_info_lr_scheduler.load_state_dict(
+                train_state['loss_weight_scheduler'])
+        if self.use_lstm:
+            self.task_lstm_optimizer.load_state_dict(
+                train_state['lstm_optimizer'])
+            self.lstm_lr_scheduler.load_state_dict(
+                train_state['lstm_scheduler'])
+        if self._use_learnable_params:
+            self.lr_optimizer.load_state_dict(
+                train_state['learning_rate_optimizer'])
+
     def _save_model(self, best=True):
         '''
             save meta paramters
         '''
-        if best:
-            save_path = os.path.join(
-                self._save_dir, f"{self.args.model}_{self._train_step}_best_{self.args.mode}_{self.args.model}.pt")
-        else:
-            save_path = os.path.join(
-                self._save_dir, f"{self.args.model}_{self._train_step}_{self.args.mode}_{self.args.model}.pt")
+        save_path = self.checkpoint_path(self._train_step, best)
         model_dict = {
             'meta_model': self.model.state_dict(),
             'meta_model_scheduler': self.meta_lr_scheduler.state_dict(),
@@ -773,7 +1124,13 @@ class MAML:
             model_dict['lstm_model'] = self.task_lstm_network.state_dict()
         if self._use_learnable_params:
             model_dict['learning_rate'] = self.inner_loop_optimizer.state_dict()
-        torch.save(model_dict, save_path)
+        model_dict['model_config'] = {
+            'model': self.args.model,
+            'num_users': self.args.num_users,
+            'num_items': self.args.num_items,
+        }
+        model_dict['train_state'] = self.train_state_dict()
+        self.checkpoint_writer.save(model_dict, save_path)
 
     def _load_pretrained_embedding(self):
         """
@@ -785,11 +1142,11 @@ class MAML:
             map_location = 'cpu'
 
         if self.args.model == 'sasrec' or self.args.model == 'bert4rec':
-            self.model.bert.bert_embedding.load_state_dict(torch.load(
+            self.model.bert.bert_embedding.load_state_dict(load_state_dict_file(
                 os.path.join(self._embedding_dir, f"{self.args.model}_embedding_{self.args.mode}_{self.args.bert_hidden_units}_{self.args.bert_num_blocks}_{self.args.bert_num_heads}"), map_location=map_location))
 
         else:
-            self.model.embedding.load_state_dict(torch.load(
+            self.model.embedding.load_state_dict(load_state_dict_file(
                 os.path.join(self._embedding_dir, f"{self.args.model}_embedding_{self.args.mode}"), map_location=map_location))
 
     def _load_pretrained(self):
@@ -801,10 +1158,20 @@ class MAML:
         else:
             map_location = 'cpu'
 
-        self.model.load_state_dict(torch.load(
+        self.model.load_state_dict(load_state_dict_file(
             os.path.join(self._pretrained_dir, f"{self.args.model}_pretrained_{self.args.mode}_{self.args.bert_hidden_units}_{self.args.bert_num_blocks}_{self.args.bert_num_heads}"), map_location=map_location))
 
 
+def checkpoint_path(args, checkpoint_step, best=True, ext='.ckpt'):
+    '''
+        path of a checkpoint, ext is .ckpt (directory layout) or .pt (legacy single file)
+    '''
+    name = f"{args.model}_{checkpoint_step}"
+    if best:
+        name += "_best"
+    return os.path.join(args.log_dir, 'state', f"{name}_{args.mode}_{args.model}{ext}")
+
+
 def main(args):
     if args.log_dir is None:
         args.log_dir = os.path.join(os.path.abspath('.'), "log/")
@@ -815,9 +1182,11 @@ def main(args):
         args
     )
 
-    if args.checkpoint_step > -1:
+    if args.resume:
+        maml.resume()
+    elif args.checkpoint_step > -1:
         maml._train_step = args.checkpoint_step
-        maml.load(args.checkpoint_step, args.test_best)
+        maml.load(args.checkpoint_step, args.test_best, training=not args.test)
     else:
         print('Checkpoint loading skipped.')
 
@@ -831,4 +1200,4 @@ def main(args):
 
 
 if __name__ == '__main__':
-    main(args)
+    main(parse_args())
@@ -0,0 +1,177 @@
+import csv
+import json
+import os
+import threading
+import time
+
+
+class MetricsSink():
+    """
+        Destination of logged metrics.
+        init starts a run, log records a dict of scalars, close flushes and ends the run.
+    """
+
+    def init(self, project, config):
+        pass
+
+    def log(self, metrics, step=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalSink(MetricsSink):
+    """
+        Buffers metrics in memory and appends them to a local jsonl or csv file
+        from a background thread, so log never waits for disk or network.
+        csv files are written in long format (time, step, name, value) since
+        different calls log different metrics.
+    """
+
+    def __init__(self, log_dir, fmt='jsonl', flush_interval=5.0):
+        self.log_dir = log_dir
+        self.fmt = fmt
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.path = None
+
+    def init(self, project, config):
+        os.makedirs(self.log_dir, exist_ok=True)
+        run_name = f"{project}_{time.strftime('%Y%m%d-%H%M%S')}"
+        self.path = os.path.join(self.log_dir, f"{run_name}.{self.fmt}")
+        with open(os.path.join(self.log_dir, f"{run_name}_config.json"), 'w') as f:
+            json.dump(vars(config), f, default=str, indent=1)
+        if self.fmt == 'csv':
+            with open(self.path, 'w', newline='') as f:
+                csv.writer(f).writerow(['time', 'step', 'name', 'value'])
+        print('Logging metrics to', self.path)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, metrics, step=None):
+        with self.lock:
+            self.buffer.append((time.time(), step, dict(metrics)))
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        if len(records) == 0 or self.path is None:
+            return
+        with open(self.path, 'a', newline='') as f:
+            if self.fmt == 'csv':
+                writer = csv.writer(f)
+                for timestamp, step, metrics in records:
+                    for name, value in metrics.items():
+                        writer.writerow([timestamp, step, name, value])
+            else:
+                for timestamp, step, metrics in records:
+                    f.write(json.dumps(
+                        {'time': timestamp, 'step': step, **metrics}, default=float) + '\n')
+
+    def close(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+class WandbSink(MetricsSink):
+    """
+        Weights & Biases run, wandb is only imported when this backend is used.
+    """
+
+    def init(self, project, config):
+        import wandb
+        self.wandb = wandb
+        self.run = wandb.init(project=project)
+        wandb.config.update(config)
+
+    def log(self, metrics, step=None):
+        self.wandb.log(metrics, step=step)
+
+    def close(self):
+        self.run.finish()
+
+
+class TensorboardSink(MetricsSink):
+    """
+        tensorboard event files in log_dir/{project}
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.writer = None
+        self.num_logs = 0
+
+    def init(self, project, config):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir=os.path.join(self.log_dir, project))
+
+    def log(self, metrics, step=None):
+        # tensorboard needs a step, fall back to the number of log calls
+        if step is None:
+            step = self.num_logs
+        self.num_logs += 1
+        for name, value in metrics.items():
+            self.writer.add_scalar(name, value, step)
+
+    def close(self):
+        self.writer.close()
+
+
+class MultiSink(MetricsSink):
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def init(self, project, config):
+        for sink in self.sinks:
+            sink.init(project, config)
+
+    def log(self, metrics, step=None):
+        for sink in self.sinks:
+            sink.log(metrics, step)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def make_metrics_sink(args, log_dir):
+    '''
+    build the sink of args.metrics_backend
+
+    Args:
+        args : options with metrics_backend (comma separated list of jsonl, csv, wandb,
+               tensorboard or none) and metrics_flush_interval
+        log_dir : directory of local and tensorboard logs
+    return:
+        sink : MetricsSink
+    '''
+    sinks = []
+    for backend in args.metrics_backend.split(','):
+        backend = backend.strip()
+        if backend in ('jsonl', 'csv'):
+            sinks.append(LocalSink(os.path.join(log_dir, 'metrics'),
+                         fmt=backend, flush_interval=args.metrics_flush_interval))
+        elif backend == 'wandb':
+            sinks.append(WandbSink())
+        elif backend == 'tensorboard':
+            sinks.append(TensorboardSink(os.path.join(log_dir, 'tensorboard')))
+        elif backend in ('none', ''):
+            continue
+        else:
+            raise ValueError(f'Unknown metrics backend: {backend}')
+    if len(sinks) == 1:
+        return sinks[0]
+    return MultiSink(sinks)
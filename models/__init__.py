@@ -1,19 +1,30 @@
-from .meta_sasrec_model import MetaSASRec
-from .meta_narm_model import MetaNARM
-from .meta_bert_model import MetaBERT4Rec
-from .meta_grurec_model import MetaGRU4REC
-from .meta_ncf_model import MetaNCF
+import importlib
 
 
+# model name -> (module, class name), model modules are imported on first use
 MODELS = {
-    'bert4rec': MetaBERT4Rec,
-    'sasrec': MetaSASRec,
-    'narm': MetaNARM,
-    'gru4rec': MetaGRU4REC,
-    'ncf': MetaNCF
+    'bert4rec': ('.meta_bert_model', 'MetaBERT4Rec'),
+    'sasrec': ('.meta_sasrec_model', 'MetaSASRec'),
+    'narm': ('.meta_narm_model', 'MetaNARM'),
+    'gru4rec': ('.meta_grurec_model', 'MetaGRU4REC'),
+    'ncf': ('.meta_ncf_model', 'MetaNCF')
 }
 
 
+def get_model_class(name):
+    module_name, class_name = MODELS[name]
+    module = importlib.import_module(module_name, __name__)
+    return getattr(module, class_name)
+
+
 def model_factory(args):
-    model = MODELS[args.model]
+    model = get_model_class(args.model)
     return model(args)
+
+
+def __getattr__(name):
+    # keep "from models import MetaSASRec" working
+    for model_name, (_, class_name) in MODELS.items():
+        if class_name == name:
+            return get_model_class(model_name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
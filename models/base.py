@@ -125,14 +125,19 @@ class MetaPositionalEmbedding(nn.Module):
         self.weights = nn.Parameter(torch.ones(max_len+1, d_model))
         nn.init.xavier_uniform_(self.weights)
 
-    def forward(self, x, params=None):
+    def forward(self, x, params=None, offset=0):
+        '''
+            offset : number of positions that follow x (x is a prefix of the encoded sequence)
+        '''
         if params is not None:
             params = extract_top_level_dict(current_dict=params)
             weight = params["weights"]
         else:
             weight = self.weights
-        batch_size = x.size(0)
-        return weight.unsqueeze(0).repeat(batch_size, 1, 1)
+        # sequences are left padded, so positions are aligned to the end
+        batch_size, seq_len = x.shape
+        end = weight.size(0) - offset
+        return weight[end - seq_len:end].unsqueeze(0).expand(batch_size, -1, -1)
 
 
 class MetaBERTEmbedding(nn.Module):
@@ -163,7 +168,7 @@ class MetaBERTEmbedding(nn.Module):
 
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, inputs, params=None):
+    def forward(self, inputs, params=None, position_offset=0):
         user_id, product_history, target_product_id,  product_history_ratings = inputs
 
         if params is not None:
@@ -179,7 +184,8 @@ class MetaBERTEmbedding(nn.Module):
         x = self.embedding(product_his, params=embedding_params)
 
         if self.needs_position:
-            x += self.position(product_his, params=position_params)
+            x += self.position(product_his, params=position_params,
+                               offset=position_offset)
         B, T = product_history_ratings.shape
 
         return self.dropout(x)
@@ -251,8 +257,7 @@ class MetaGRUModel(nn.Module):
 
         self.h0 = nn.Parameter(torch.randn(num_layers, hidden_size))
 
-    def forward(self, x, params=None):
-
+    def split_params(self, params):
         param_dict = {}
         if params is not None:
             param_dict = extract_top_level_dict(current_dict=params)
@@ -265,15 +270,50 @@ class MetaGRUModel(nn.Module):
             layer_name = path_bits[0]
             if layer_name not in param_dict:
                 param_dict[layer_name] = None
+        return param_dict, h0
+
+    def forward(self, x, params=None, mask=None):
+        '''
+        :param x: input sequence (b, t, d)
+        :param mask: optional (b, t) mask of real items, hidden states are carried
+        unchanged over padding steps so that every sequence starts from h0
+        '''
+        param_dict, h0 = self.split_params(params)
+        outs, _ = self.steps(x, param_dict, h0, mask=mask)
+        # Take only last time step. Modify for seq to seq
+        h_n = outs[:, -1]
+        out = self.layer_dict['fc'](outs, params=param_dict['fc'])
+
+        return out, h_n
 
+    def output(self, outs, params=None):
+        '''
+            forward's output layer applied to hidden states returned by run
+        '''
+        param_dict, _ = self.split_params(params)
+        return self.layer_dict['fc'](outs, params=param_dict['fc'])
+
+    def run(self, x, hidden=None, params=None, mask=None):
+        '''
+        :param x: input sequence (b, t, d)
+        :param hidden: hidden state of every layer to start from, h0 when None
+        :param mask: optional (b, t) mask of real items, as in forward
+        :return: last layer hidden states of every step (b, t, h), the hidden state of every layer after x
+        '''
+        param_dict, h0 = self.split_params(params)
+        return self.steps(x, param_dict, h0, hidden=hidden, mask=mask)
+
+    def steps(self, x, param_dict, h0, hidden=None, mask=None):
         outs = []
 
         b, _, _ = x.shape
-        h0 = h0.repeat(b, 1, 1).permute(1, 0, 2)
-
-        hidden = list()
-        for layer in range(self.num_layers):
-            hidden.append(h0[layer, :, :])
+        if hidden is None:
+            h0 = h0.repeat(b, 1, 1).permute(1, 0, 2)
+            hidden = list()
+            for layer in range(self.num_layers):
+                hidden.append(h0[layer, :, :])
+        else:
+            hidden = list(hidden)
 
         for t in range(x.size(1)):
 
@@ -285,17 +325,14 @@ class MetaGRUModel(nn.Module):
                 else:
                     hidden_l = self.layer_dict[layer_name](
                         hidden[layer - 1], hidden[layer], params=param_dict[layer_name])
+                if mask is not None:
+                    hidden_l = torch.where(
+                        mask[:, t:t+1], hidden_l, hidden[layer])
                 hidden[layer] = hidden_l
 
             outs.append(hidden_l)
 
-        out = torch.stack(outs).permute(1, 0, 2)
-        # Take only last time step. Modify for seq to seq
-        # out = outs[-1].squeeze()
-        h_n = outs[-1]
-        out = self.layer_dict['fc'](out, params=param_dict['fc'])
-
-        return out, h_n
+        return torch.stack(outs).permute(1, 0, 2), hidden
 
 
 ################### gelu and layer norm #######################################
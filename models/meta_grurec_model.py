@@ -21,6 +21,7 @@ class MetaGRU4REC(nn.Module):
         num_items = args.num_items
         vocab_size = num_items + 2
         self.device = args.device
+        self.skip_padding = args.trim_padding
         self.embedding_dim = args.gru4rec_embedding_dim
         self.embedding = MetaBERTEmbedding(
             vocab_size=vocab_size,  embed_size=self.embedding_dim, max_len=max_len, dropout=dropout, needs_position=False)
@@ -45,7 +46,12 @@ class MetaGRU4REC(nn.Module):
             out_params = None
 
         x = self.embedding(inputs, params=embedding_params)
-        gru_out, h_n = self.gru(x, params=gru_params)
+        # skip leading padding steps of each sequence
+        if self.skip_padding:
+            gru_mask = torch.cat((inputs[1], inputs[2]), dim=1) > 0
+        else:
+            gru_mask = None
+        gru_out, h_n = self.gru(x, params=gru_params, mask=gru_mask)
 
         # out = gru_out[:, -1, :]
 
@@ -58,6 +64,75 @@ class MetaGRU4REC(nn.Module):
 
         return 0.1 + torch.sigmoid(out)
 
+    def split_params(self, params):
+        if params is None:
+            return {}
+        return extract_top_level_dict(current_dict=dict(params))
+
+    def run_gru(self, product_ids, hidden=None, params=None):
+        '''
+            embedding and gru over product_ids (b x t), starting from hidden (h0 when None)
+        '''
+        param_dict = self.split_params(params)
+        # the embedding concatenates history and target, ratings are unused
+        inputs = (None, product_ids[:, :-1], product_ids[:, -1:],
+                  product_ids[:, :-1].float())
+        x = self.embedding(inputs, params=param_dict.get('embedding'))
+        mask = product_ids > 0 if self.skip_padding else None
+        return self.gru.run(x, hidden=hidden, params=param_dict.get('gru'), mask=mask)
+
+    def encode_history(self, inputs, params=None):
+        '''
+        hidden state of every gru layer after a history
+
+        Args:
+            inputs : (user_id, product_history, target_product_id, product_history_ratings) of one
+                     query row, its product_history (1 x T, padded as in the query set) is encoded
+            params : (adapted) parameters
+        return:
+            hidden : per layer hidden state (1 x hidden_size)
+        '''
+        _, hidden = self.run_gru(inputs[1], params=params)
+        return hidden
+
+    def append_history(self, hidden, product_ids, params=None):
+        '''
+        advance the hidden state of encode_history by interactions appended to the history,
+        one gru step per product. this equals encoding the longer history only with
+        --trim_padding (otherwise padding steps before the history differ, so it raises)
+        and while the history fits in max_seq_len-1; callers encode the history again
+        beyond that (Predictor.append)
+
+        Args:
+            hidden : encode_history or append_history state (batch of 1)
+            product_ids : 1 x k appended products
+        '''
+        if not self.skip_padding:
+            raise ValueError(
+                'appending to a hidden state needs --trim_padding, encode the history again')
+        _, hidden = self.run_gru(product_ids, hidden=hidden, params=params)
+        return hidden
+
+    def score_targets(self, hidden, target_product_id, params=None):
+        '''
+        outputs of the last position for targets that follow an encoded history,
+        one gru step per target
+
+        Args:
+            hidden : encode_history or append_history state (batch of 1)
+            target_product_id : N x 1 products
+            params : the parameters hidden was encoded with
+        return:
+            outputs : N outputs, forward(history followed by each target)[:, -1]
+        '''
+        param_dict = self.split_params(params)
+        num_targets = target_product_id.size(0)
+        hidden = [h.expand(num_targets, -1) for h in hidden]
+        outs, _ = self.run_gru(target_product_id, hidden=hidden, params=params)
+        out = self.relu(self.gru.output(outs[:, -1], params=param_dict.get('gru')))
+        out = self.out_layer(out, params=param_dict.get('out_layer'))
+        return 0.1 + torch.sigmoid(out.view(-1))
+
     def zero_grad(self, params=None):
         if params is None:
             for param in self.parameters():
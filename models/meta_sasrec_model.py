@@ -12,16 +12,17 @@ from .base import extract_top_level_dict,  MetaBERTEmbedding, MetaLinearLayer, M
 class MaskedAttention(nn.Module):
     """
     Compute 'Scaled Dot Product Attention
+    offset : number of cached positions before the queries (keys are cached + new positions)
     """
 
-    def forward(self, query, key, value, mask=None, dropout=None):
+    def forward(self, query, key, value, mask=None, dropout=None, offset=0):
         scores = torch.matmul(query, key.transpose(-2, -1)) \
             / math.sqrt(query.size(-1))
 
         if mask is not None:
             scores = scores.masked_fill(mask == 0, -1e9)
 
-        scores = torch.tril(scores)
+        scores = torch.tril(scores, diagonal=offset)
         scores = scores.masked_fill(scores == 0, float('-inf'))
         p_attn = F.softmax(scores, dim=-1)
 
@@ -55,7 +56,11 @@ class MetaMultiHeadedAttention(nn.Module):
 
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, query, key, value, mask=None, params=None):
+    def forward(self, query, key, value, mask=None, params=None, past=None, use_cache=False):
+        '''
+            past : (keys, values) of previous positions, the inputs are the positions that follow them
+            use_cache : also return (keys, values) of all positions
+        '''
         param_dict = {}
         if params is not None:
             param_dict = extract_top_level_dict(current_dict=params)
@@ -75,16 +80,24 @@ class MetaMultiHeadedAttention(nn.Module):
                 i)]).view(batch_size, -1, self.h, self.d_k).transpose(1, 2))
 
         query, key, value = lst
+        offset = 0
+        if past is not None:
+            offset = past[0].size(2)
+            key = torch.cat((past[0], key), dim=2)
+            value = torch.cat((past[1], value), dim=2)
 
         # 2) Apply attention on all the projected vectors in batch.
         x, attn = self.attention(
-            query, key, value, mask=mask, dropout=self.dropout)
+            query, key, value, mask=mask, dropout=self.dropout, offset=offset)
 
         # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous().view(
             batch_size, -1, self.h * self.d_k)
 
-        return self.layer_dict['out_linear'](x, params=param_dict['out_linear'])
+        x = self.layer_dict['out_linear'](x, params=param_dict['out_linear'])
+        if use_cache:
+            return x, (key, value)
+        return x
 
 
 class MetaTransformerBlock(nn.Module):
@@ -112,7 +125,7 @@ class MetaTransformerBlock(nn.Module):
             size=hidden, dropout=dropout)
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, x, mask=None, params=None):
+    def forward(self, x, mask=None, params=None, past=None, use_cache=False):
         if params is not None:
             params = extract_top_level_dict(current_dict=params)
 
@@ -125,10 +138,22 @@ class MetaTransformerBlock(nn.Module):
             feed_forward_params = None
             input_sublayer_params = None
             output_sublayer_params = None
+        present = []
+
+        def attention(_x):
+            if not use_cache:
+                return self.attention.forward(_x, _x, _x, mask=mask, params=attention_params, past=past)
+            out, key_value = self.attention.forward(
+                _x, _x, _x, mask=mask, params=attention_params, past=past, use_cache=True)
+            present.append(key_value)
+            return out
+
         x = self.input_sublayer(
-            x, lambda _x: self.attention.forward(_x, _x, _x, mask=mask, params=attention_params), params=input_sublayer_params)
+            x, attention, params=input_sublayer_params)
         x = self.output_sublayer(
             x, self.feed_forward, params=output_sublayer_params, sub_params=feed_forward_params)
+        if use_cache:
+            return self.dropout(x), present[0]
         return self.dropout(x)
 
 ## sas ##
@@ -163,7 +188,12 @@ class MetaSAS(nn.Module):
             self.layer_dict['transformer{}'.format(i)] = MetaTransformerBlock(
                 hidden, heads, hidden * 4, dropout)
 
-    def forward(self, inputs, params=None):
+    def forward(self, inputs, params=None, past=None, use_cache=False, position_offset=0):
+        '''
+            past : per layer (keys, values) of the positions before inputs
+            use_cache : also return per layer (keys, values) of all positions
+            position_offset : number of positions that will follow inputs
+        '''
         # (x > 0).unsqueeze(1).repeat(1, x.size(1), 1).unsqueeze(1)
         mask = None
         param_dict = {}
@@ -180,12 +210,20 @@ class MetaSAS(nn.Module):
                 param_dict[layer_name] = None
 
         # embedding the indexed sequence to sequence of vectors
-        x = self.bert_embedding(inputs, params=bert_embedding_params)
+        x = self.bert_embedding(
+            inputs, params=bert_embedding_params, position_offset=position_offset)
 
         # running over multiple transformer blocks
+        presents = []
         for i in range(self.n_layers):
             x = self.layer_dict['transformer{}'.format(i)].forward(
-                x, mask, params=param_dict['transformer{}'.format(i)])
+                x, mask, params=param_dict['transformer{}'.format(i)],
+                past=None if past is None else past[i], use_cache=use_cache)
+            if use_cache:
+                x, key_value = x
+                presents.append(key_value)
+        if use_cache:
+            return x, presents
         return x
 
 
@@ -224,6 +262,57 @@ class MetaSASRec(nn.Module):
         # x = self.out2(x, params=out2_params)
         return 0.1 + torch.sigmoid(x)
 
+    def split_params(self, params):
+        if params is None:
+            return None, None
+        param_dict = extract_top_level_dict(current_dict=dict(params))
+        return param_dict['bert'], param_dict['dim_reduct']
+
+    def encode_history(self, inputs, params=None):
+        '''
+        per-layer keys and values of a history, shared by every target scored after it
+
+        attention is causal, so history positions do not depend on the target. positions
+        are aligned to the end of the sequence, which means an appended interaction shifts
+        every position: after an append the history has to be encoded again.
+
+        Args:
+            inputs : (user_id, product_history, target_product_id, product_history_ratings) of one
+                     query row, its product_history (1 x T, padded as in the query set) is encoded
+            params : (adapted) parameters
+        return:
+            past : per layer (keys, values) of the T history positions
+        '''
+        bert_params, _ = self.split_params(params)
+        user_id, product_history, _, product_history_ratings = inputs
+        history_inputs = (user_id, product_history[:, :-1], product_history[:, -1:],
+                          product_history_ratings[:, :-1])
+        _, past = self.bert(history_inputs, params=bert_params,
+                            use_cache=True, position_offset=1)
+        return past
+
+    def score_targets(self, past, target_product_id, params=None):
+        '''
+        outputs of the last position for targets that follow an encoded history,
+        each layer attends from one position over the cached keys and values
+
+        Args:
+            past : encode_history of the history (batch of 1)
+            target_product_id : N x 1 products
+            params : the parameters past was encoded with
+        return:
+            outputs : N outputs, forward(history followed by each target)[:, -1]
+        '''
+        bert_params, dim_reduct_params = self.split_params(params)
+        num_targets = target_product_id.size(0)
+        past = [(key.expand(num_targets, -1, -1, -1), value.expand(num_targets, -1, -1, -1))
+                for key, value in past]
+        no_history = target_product_id[:, :0]
+        inputs = (None, no_history, target_product_id, no_history.float())
+        x = self.bert(inputs, params=bert_params, past=past)
+        x = self.dim_reduct(x[:, -1], params=dim_reduct_params)
+        return 0.1 + torch.sigmoid(x.view(-1))
+
     def zero_grad(self, params=None):
         if params is None:
             for param in self.parameters():
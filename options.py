@@ -14,7 +14,7 @@ parser.add_argument('--log_dir', type=str, default='./log',
 parser.add_argument('--data_path', type=str, default='./Data/ml-1m/ratings.dat',
                     help='data path')
 parser.add_argument('--mode', type=str, default='ml-1m',
-                    help='ml-1m or ml-10m or amazon or yelp')
+                    help='ml-1m or ml-10m or amazon or yelp or synthetic')
 parser.add_argument('--test', default=False, action='store_true',
                     help='train or test')
 parser.add_argument('--test_best', default=True, action='store_false',
@@ -24,6 +24,106 @@ parser.add_argument('--test_baseline', default=False, action='store_true',
 parser.add_argument('--checkpoint_step', type=int, default=-1,
                     help=('checkpoint iteration to load for resuming '
                           'training, or for evaluation (-1 is ignored)'))
+parser.add_argument('--keep_last_checkpoints', type=int, default=-1,
+                    help='number of latest checkpoints written by this run to keep (-1 keeps all)')
+parser.add_argument('--keep_best_checkpoints', type=int, default=-1,
+                    help='number of best checkpoints written by this run to keep (-1 keeps all)')
+parser.add_argument('--async_checkpoint', type=boolean_string, default=True,
+                    help='write checkpoints from a background thread')
+parser.add_argument('--resume', default=False, action='store_true',
+                    help='resume training exactly from the latest checkpoint in log_dir/state')
+parser.add_argument('--sweep_start', type=int, default=-1,
+                    help='first checkpoint step evaluated by sweep.py (-1 is ignored)')
+parser.add_argument('--sweep_end', type=int, default=-1,
+                    help='last checkpoint step evaluated by sweep.py (-1 is ignored)')
+parser.add_argument('--sweep_checkpoints', type=str, default='all',
+                    help='checkpoints evaluated by sweep.py - all, best or regular')
+parser.add_argument('--sweep_num_workers', type=int, default=2,
+                    help='number of evaluation processes of sweep.py')
+parser.add_argument('--sweep_output', type=str, default=None,
+                    help='csv file to write sweep results to')
+parser.add_argument('--metrics_backend', type=str, default='jsonl',
+                    help='comma separated metrics sinks - jsonl, csv, wandb, tensorboard or none')
+parser.add_argument('--metrics_flush_interval', type=float, default=5.0,
+                    help='seconds between background flushes of local metrics files')
+parser.add_argument('--profile_phases', type=boolean_string, default=False,
+                    help='time the phases of every meta-training iteration')
+parser.add_argument('--profile_sync', type=boolean_string, default=False,
+                    help='synchronize cuda at phase boundaries for accurate gpu phase times')
+parser.add_argument('--profile_window', type=int, default=100,
+                    help='number of iterations of rolling phase time percentiles')
+parser.add_argument('--profile_trace_dir', type=str, default=None,
+                    help='export a torch.profiler trace of a few training iterations to this directory')
+parser.add_argument('--profile_trace_steps', type=int, default=5,
+                    help='number of iterations recorded in the torch.profiler trace')
+parser.add_argument('--profile_memory', type=boolean_string, default=False,
+                    help='record inner loop memory and autograd graph size per task and inner step')
+parser.add_argument('--profile_memory_steps', type=int, default=1,
+                    help='number of training iterations recorded by the memory profiler')
+parser.add_argument('--benchmarks', type=str, default='generate_task,models,outer_loop,eval,adapt,pretrain_epoch',
+                    help='comma separated benchmarks run by benchmark.py')
+parser.add_argument('--benchmark_models', type=str, default='bert4rec,sasrec,narm,gru4rec,ncf',
+                    help='models of the model forward/backward benchmark')
+parser.add_argument('--benchmark_repeats', type=int, default=20,
+                    help='timed repetitions of short benchmarks')
+parser.add_argument('--benchmark_long_repeats', type=int, default=3,
+                    help='timed repetitions of eval and pretraining epoch benchmarks')
+parser.add_argument('--benchmark_warmup', type=int, default=2,
+                    help='untimed repetitions before timing')
+parser.add_argument('--benchmark_output', type=str, default='benchmark.json',
+                    help='json file of benchmark results')
+parser.add_argument('--benchmark_baseline', type=str, default=None,
+                    help='benchmark json file to compare against (exit code 1 on regression)')
+parser.add_argument('--benchmark_tolerance', type=float, default=0.1,
+                    help='allowed relative slowdown against the baseline')
+parser.add_argument('--scaling_num_items', type=str, default='1000,10000,100000',
+                    help='synthetic catalog sizes swept by scaling.py (empty : skip)')
+parser.add_argument('--scaling_max_seq_len', type=str, default='10,30,100,300',
+                    help='maximum sequence lengths swept by scaling.py (empty : skip)')
+parser.add_argument('--scaling_num_samples', type=str, default='5,25,100',
+                    help='support set sizes swept by scaling.py (empty : skip)')
+parser.add_argument('--scaling_num_inner_steps', type=str, default='1,3,5,10',
+                    help='inner steps swept by scaling.py (empty : skip)')
+parser.add_argument('--scaling_batch_size', type=str, default='4,16,64',
+                    help='task batch sizes swept by scaling.py (empty : skip)')
+parser.add_argument('--scaling_models', type=str, default='bert4rec,sasrec,narm,gru4rec,ncf',
+                    help='models swept by scaling.py, every other axis is swept for each model')
+parser.add_argument('--scaling_output_dir', type=str, default='./scaling',
+                    help='directory of scaling.py results and curves')
+parser.add_argument('--scaling_timeout', type=int, default=1800,
+                    help='seconds before a scaling point is stopped')
+parser.add_argument('--history', type=str, default='',
+                    help='rated history of inference.py - item:rating,item:rating,...')
+parser.add_argument('--targets', type=str, default='',
+                    help='products whose ratings inference.py predicts - item,item,...')
+parser.add_argument('--weight_cache_size', type=int, default=1024,
+                    help='adapted weights of this many users are cached by inference.py (0 : no cache)')
+parser.add_argument('--weight_cache_mb', type=float, default=256,
+                    help='memory limit of the adapted weights cache')
+parser.add_argument('--weight_cache_rank', type=int, default=0,
+                    help='store dense 2d weight deltas as rank-r factors, approximate (0 : exact)')
+parser.add_argument('--weight_cache_sparse_ratio', type=float, default=0.5,
+                    help='2d weight deltas with at most this fraction of changed rows are stored as sparse rows')
+parser.add_argument('--incremental_steps', type=int, default=1,
+                    help='inner steps of a warm-started re-adaptation after new interactions (0 : always adapt from scratch)')
+parser.add_argument('--incremental_max_new', type=int, default=5,
+                    help='histories with more new interactions than this since the cached one are adapted from scratch')
+parser.add_argument('--incremental_max_updates', type=int, default=10,
+                    help='consecutive warm-started re-adaptations before a full adaptation')
+parser.add_argument('--server_host', type=str, default='127.0.0.1',
+                    help='loopback address of the inference server')
+parser.add_argument('--server_port', type=int, default=8080,
+                    help='port of the inference server')
+parser.add_argument('--server_unix_socket', type=str, default=None,
+                    help='serve on this unix socket instead of host:port')
+parser.add_argument('--server_batch_window_ms', type=float, default=5.0,
+                    help='time the server waits for more requests after the first one of a batch')
+parser.add_argument('--server_max_batch_size', type=int, default=32,
+                    help='maximum number of users adapted in one batch')
+parser.add_argument('--server_max_queue', type=int, default=1024,
+                    help='pending requests before the server answers 503')
+parser.add_argument('--server_timeout_ms', type=float, default=1000.0,
+                    help='requests not answered within this time get 504')
 parser.add_argument('--log_interval', type=int, default=50,
                     help=('validation error logging interval'))
 parser.add_argument('--num_test_data', type=int, default=1000,
@@ -34,8 +134,28 @@ parser.add_argument('--use_random_sequence_length', type=boolean_string, default
                     help='make sequence length random number between min sequence and max_len')
 parser.add_argument('--min_item', type=int, default=50,
                     help='minimum number of reviews items should have')
+parser.add_argument('--chunk_size', type=int, default=1000000,
+                    help='number of rows read at once when streaming amazon or yelp csv files')
+parser.add_argument('--kcore_max_iter', type=int, default=-1,
+                    help='maximum number of item/user filtering rounds, at least one is run (-1 : until every user and item satisfies the minimums)')
+parser.add_argument('--synthetic_num_users', type=int, default=2000,
+                    help='number of users of the synthetic dataset')
+parser.add_argument('--synthetic_num_items', type=int, default=1000,
+                    help='number of items of the synthetic dataset')
+parser.add_argument('--synthetic_mean_length', type=int, default=30,
+                    help='median history length of synthetic users')
+parser.add_argument('--synthetic_length_sigma', type=float, default=1.0,
+                    help='spread of log-normal synthetic history lengths')
+parser.add_argument('--synthetic_item_zipf', type=float, default=1.0,
+                    help='zipf exponent of synthetic item popularity (0 : uniform)')
+parser.add_argument('--synthetic_rating_skew', type=float, default=0.5,
+                    help='skew of synthetic ratings towards high ratings (0 : uniform)')
 parser.add_argument('--random_seed', type=int, default=222,
                     help=('test data random seed'))
+parser.add_argument('--use_task_store', type=boolean_string, default=False,
+                    help='generate valid and test tasks once and read them back from disk')
+parser.add_argument('--task_store_dir', type=str, default='./Data/task_store',
+                    help='directory of frozen valid and test tasks')
 
 # hyperparmeters for training
 parser.add_argument('--num_inner_steps', type=int, default=3,
@@ -116,6 +236,10 @@ parser.add_argument('--num_items', type=int, default=0,
                     help='number of items')
 parser.add_argument('--batch_size', type=int, default=16,
                     help='batch size')
+parser.add_argument('--bucket_by_length', type=boolean_string, default=False,
+                    help='draw each train task batch from users with similar history length')
+parser.add_argument('--num_length_buckets', type=int, default=4,
+                    help='number of history length buckets')
 parser.add_argument('--val_size', type=int, default=600,
                     help='val batch size')
 parser.add_argument('--num_samples', type=int, default=25,
@@ -126,6 +250,9 @@ parser.add_argument('--default_rating', type=int, default=0,
                     help='rating value for padding')
 parser.add_argument('--min_sub_window_size', type=int, default=2,
                     help=('minimum sequence during subsampling'))
+parser.add_argument('--trim_padding', type=boolean_string, default=False,
+                    help=('trim batches to the longest real sequence and skip padding steps in gru models '
+                          '(not with sasrec, which attends over padding)'))
 parser.add_argument('--use_label', type=boolean_string, default=True,
                     help='use label as task information or input rating data as task information')
 
@@ -167,6 +294,12 @@ parser.add_argument('--task_info_predictions', type=boolean_string, default=True
 # pretraining options
 parser.add_argument('--pretraining_batch_size', type=int, default=128,
                     help='batch size during pretraining')
+parser.add_argument('--pretraining_num_workers', type=int, default=0,
+                    help='number of (persistent) dataloader workers during pretraining')
+parser.add_argument('--pretrain_world_size', type=int, default=1,
+                    help='number of data parallel processes during pretraining (gloo backend)')
+parser.add_argument('--dist_url', type=str, default='tcp://127.0.0.1:29500',
+                    help='init method of the data parallel process group')
 parser.add_argument('--pretrain_epochs', type=int, default=100,
                     help='the number of epochs for pretraining')
 parser.add_argument('--pretraining_lr', type=float, default=1e-3,
@@ -182,4 +315,9 @@ parser.add_argument('--use_learned_loss_baseline', type=boolean_string, default=
 parser.add_argument('--pretrain_log_dir', type=str, default='./log_pretrained',
                     help='directory to save to or load from pretrained')
 
-args = parser.parse_args()
+
+def parse_args(argv=None):
+    '''
+        parse command line options (sys.argv when argv is None)
+    '''
+    return parser.parse_args(argv)
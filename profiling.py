@@ -0,0 +1,322 @@
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+
+class _NullPhase():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase():
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        if self.timer.record_functions:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        return False
+
+
+class PhaseTimer():
+    """
+        Wall time per named phase of a training iteration.
+
+        with timer.phase('support_forward'):
+            ...
+
+        Phases may repeat within an iteration (e.g. once per inner step), their
+        times are summed. end_iteration returns the per-iteration breakdown and keeps
+        the last `window` iterations for rolling percentiles.
+        A disabled timer returns a shared no-op context, so instrumentation can stay
+        in the training code.
+        With sync, cuda is synchronized at phase boundaries so that asynchronous
+        kernels are attributed to the phase that launched them (this slows training).
+    """
+
+    def __init__(self, enabled=False, window=100, sync=False, record_functions=False):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.record_functions = record_functions
+        self.current = OrderedDict()
+        self.history = OrderedDict()
+        self.window = window
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def discard(self):
+        '''
+            drop phase times recorded since the last end_iteration (e.g. during validation)
+        '''
+        self.current = OrderedDict()
+
+    def end_iteration(self):
+        '''
+            close the current iteration
+            return:
+                breakdown : phase name -> milliseconds spent in this iteration
+        '''
+        breakdown = OrderedDict((name, seconds * 1000)
+                                for name, seconds in self.current.items())
+        for name, ms in breakdown.items():
+            if name not in self.history:
+                self.history[name] = deque(maxlen=self.window)
+            self.history[name].append(ms)
+        self.current = OrderedDict()
+        return breakdown
+
+    def percentiles(self, qs=(50, 90, 99)):
+        '''
+            phase name -> {p50: ms, ...} over the last window iterations
+        '''
+        return OrderedDict(
+            (name, {f'p{q}': float(np.percentile(values, q)) for q in qs})
+            for name, values in self.history.items() if len(values) > 0)
+
+    def summary(self, qs=(50, 90, 99)):
+        lines = [f"{'phase':<20}" + ''.join(f"{f'p{q} ms':>12}" for q in qs)]
+        for name, values in self.percentiles(qs).items():
+            lines.append(f'{name:<20}' + ''.join(
+                f'{values[f"p{q}"]:>12.2f}' for q in qs))
+        return '\n'.join(lines)
+
+
+def format_breakdown(breakdown):
+    total = sum(breakdown.values())
+    return ' | '.join(f'{name}: {ms:.1f}ms ({ms / max(total, 1e-12):.0%})'
+                      for name, ms in breakdown.items())
+
+
+def make_profiler(trace_dir, active_steps=5):
+    '''
+        torch.profiler that skips 1 step, warms up 1 step, records active_steps steps
+        and exports a chrome/tensorboard trace to trace_dir
+        call .step() after every iteration
+    '''
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            wait=1, warmup=1, active=active_steps, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+        profile_memory=True)
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def graph_size(tensor):
+    '''
+        number of autograd nodes reachable from tensor
+    '''
+    if tensor is None or tensor.grad_fn is None:
+        return 0
+    seen = {tensor.grad_fn}
+    stack = [tensor.grad_fn]
+    while stack:
+        node = stack.pop()
+        for next_node, _ in node.next_functions:
+            if next_node is not None and next_node not in seen:
+                seen.add(next_node)
+                stack.append(next_node)
+    return len(seen)
+
+
+class MemoryProfiler():
+    """
+        Memory of the retained inner-loop graphs of a task batch.
+
+        While tracking, every tensor autograd saves for backward is counted
+        (saved_tensors_hooks) and attributed to the component that saved it:
+        the module running forward (model, loss networks) or an explicit
+        component context such as the second-order inner gradient. Views of the
+        same storage are counted separately, so saved bytes are an upper bound.
+        Per task and inner step, cuda allocated bytes (None on cpu), saved bytes,
+        fast-weight bytes and the autograd graph size are recorded.
+    """
+
+    def __init__(self, enabled=False, modules=None):
+        self.enabled = enabled
+        self.modules = modules or {}
+        self.tracking = False
+        self.components = []
+        self.reset()
+
+    def reset(self):
+        self.records = []
+        self.task_records = []
+        self.saved_bytes = OrderedDict()
+        self.total_saved_bytes = 0
+        self.peak_allocated = 0
+        self.task = 0
+        self.task_start_bytes = 0
+
+    def allocated(self):
+        '''
+            cuda allocated bytes, None on cpu (saved bytes are recorded separately)
+        '''
+        if torch.cuda.is_available():
+            return torch.cuda.memory_allocated()
+        return None
+
+    def pack(self, tensor):
+        name = self.components[-1] if self.components else 'other'
+        size = tensor_bytes(tensor)
+        self.saved_bytes[name] = self.saved_bytes.get(name, 0) + size
+        self.total_saved_bytes += size
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    def component(self, name):
+        '''
+            attribute tensors saved inside the context to name
+        '''
+        if not self.tracking:
+            return _NULL_PHASE
+        return _Component(self, name)
+
+    def track(self, active=True):
+        '''
+            count saved tensors inside the context (one outer loop)
+        '''
+        if not (self.enabled and active):
+            return _NULL_PHASE
+        return _Tracking(self)
+
+    def start_task(self, task):
+        self.task = task
+        self.task_start_bytes = self.total_saved_bytes
+
+    def record_step(self, step, loss, names_weights):
+        if not self.tracking:
+            return
+        self.records.append({
+            'task': self.task,
+            'step': step,
+            'allocated': self.allocated(),
+            'saved_bytes': self.total_saved_bytes - self.task_start_bytes,
+            'fast_weight_bytes': sum(tensor_bytes(w) for w in names_weights.values()),
+            'graph_nodes': graph_size(loss),
+        })
+
+    def end_task(self, query_loss):
+        if not self.tracking:
+            return
+        self.task_records.append({
+            'task': self.task,
+            'allocated': self.allocated(),
+            'saved_bytes': self.total_saved_bytes - self.task_start_bytes,
+            'graph_nodes': graph_size(query_loss),
+        })
+
+    def summary(self):
+        mb = 1024 ** 2
+        lines = ['Inner loop memory']
+        if torch.cuda.is_available():
+            lines.append(f'peak allocated         : {self.peak_allocated / mb:.1f} MB')
+        lines.append(f'saved for backward     : {self.total_saved_bytes / mb:.1f} MB')
+        for name, size in self.saved_bytes.items():
+            lines.append(f'  {name:<20} : {size / mb:.1f} MB '
+                         f'({size / max(self.total_saved_bytes, 1):.0%})')
+
+        if self.records:
+            lines.append(f"{'step':>6}{'saved MB':>12}{'fast weights MB':>18}{'graph nodes':>14}")
+            steps = sorted(set(record['step'] for record in self.records))
+            for step in steps:
+                records = [r for r in self.records if r['step'] == step]
+                lines.append(
+                    f"{step:>6}"
+                    f"{np.mean([r['saved_bytes'] for r in records]) / mb:>12.2f}"
+                    f"{np.mean([r['fast_weight_bytes'] for r in records]) / mb:>18.2f}"
+                    f"{np.mean([r['graph_nodes'] for r in records]):>14.0f}")
+        if self.task_records:
+            per_task = np.mean([r['saved_bytes'] for r in self.task_records])
+            lines.append(f'retained per task      : {per_task / mb:.2f} MB '
+                         f"(graph nodes: {np.mean([r['graph_nodes'] for r in self.task_records]):.0f})")
+            lines.append(f'retained per batch     : {per_task * len(self.task_records) / mb:.1f} MB '
+                         f'for {len(self.task_records)} tasks')
+        return '\n'.join(lines)
+
+
+class _Component():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.components.append(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.components.pop()
+        return False
+
+
+class _Tracking():
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.handles = []
+
+    def __enter__(self):
+        profiler = self.profiler
+        def leave(*_):
+            # a forward hook returning a value would replace the module output
+            profiler.components.pop()
+
+        for name, module in profiler.modules.items():
+            self.handles.append(module.register_forward_pre_hook(
+                lambda *_, name=name: profiler.components.append(name)))
+            self.handles.append(module.register_forward_hook(leave))
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(
+            profiler.pack, profiler.unpack)
+        self.hooks.__enter__()
+        profiler.tracking = True
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        profiler.tracking = False
+        self.hooks.__exit__(*exc)
+        for handle in self.handles:
+            handle.remove()
+        profiler.components = []
+        if torch.cuda.is_available():
+            profiler.peak_allocated = max(
+                profiler.peak_allocated, torch.cuda.max_memory_allocated())
+        return False
@@ -0,0 +1,161 @@
+from options import parse_args
+
+import csv
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+
+def parse_values(values):
+    return [int(value) for value in values.split(',') if value.strip()]
+
+
+def axis_overrides(args, axis, value):
+    '''
+        benchmark.py options of one point of a sweep axis
+    '''
+    if axis == 'num_items':
+        # every generated item should appear, so that the embedding has value rows
+        return [f'--synthetic_num_items={value}', '--min_item=0', '--synthetic_item_zipf=0']
+    if axis == 'max_seq_len':
+        # histories have to be long enough to fill the window
+        mean_length = max(args.synthetic_mean_length, value)
+        return [f'--max_seq_len={value}', f'--synthetic_mean_length={mean_length}']
+    return [f'--{axis}={value}']
+
+
+def sweep_points(args):
+    '''
+        (model, axis, value) of every point, each axis is swept alone around the base options
+    '''
+    axes = [
+        ('num_items', parse_values(args.scaling_num_items)),
+        ('max_seq_len', parse_values(args.scaling_max_seq_len)),
+        ('num_samples', parse_values(args.scaling_num_samples)),
+        ('num_inner_steps', parse_values(args.scaling_num_inner_steps)),
+        ('batch_size', parse_values(args.scaling_batch_size)),
+    ]
+    points = []
+    for model in args.scaling_models.split(','):
+        for axis, values in axes:
+            for value in values:
+                points.append((model, axis, value))
+    return points
+
+
+def run_point(args, base_argv, model, axis, value):
+    '''
+        run benchmark.py for one point in a fresh process, so that peak memory
+        and failures (e.g. out of memory) belong to this point only
+    '''
+    name = f'{model}_{axis}_{value}'
+    output = os.path.join(args.scaling_output_dir, f'{name}.json')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.py')] + \
+        base_argv + ['--mode=synthetic', f'--model={model}', '--benchmarks=outer_loop',
+                     f'--benchmark_output={output}'] + axis_overrides(args, axis, value)
+
+    row = {'model': model, 'axis': axis, 'value': value, 'status': 'ok',
+           'iteration_ms': None, 'peak_rss_mb': None, 'peak_cuda_mb': None, 'num_items': None}
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, timeout=args.scaling_timeout)
+    except subprocess.TimeoutExpired:
+        row['status'] = 'timeout'
+        return row
+    if process.returncode != 0:
+        row['status'] = f'failed ({process.returncode})'
+        with open(os.path.join(args.scaling_output_dir, f'{name}.log'), 'w') as f:
+            f.write(process.stdout)
+        return row
+
+    with open(output) as f:
+        result = json.load(f)
+    row['iteration_ms'] = result['results']['outer_loop']['median_ms']
+    row['peak_rss_mb'] = result['memory']['peak_rss_mb']
+    row['peak_cuda_mb'] = result['memory'].get('peak_cuda_mb')
+    row['num_items'] = result['dataset']['num_items']
+    return row
+
+
+def scaling_exponent(rows):
+    '''
+        log-log slope of iteration time between consecutive points (1 : linear scaling)
+    '''
+    slopes = [None]
+    for prev, curr in zip(rows[:-1], rows[1:]):
+        if prev['iteration_ms'] is None or curr['iteration_ms'] is None:
+            slopes.append(None)
+            continue
+        slopes.append(float(np.log(curr['iteration_ms'] / prev['iteration_ms']) /
+                            np.log(curr['value'] / prev['value'])))
+    return slopes
+
+
+def plot_curves(args, rows):
+    '''
+        one png per axis, skipped when matplotlib is not installed
+    '''
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is not installed, skipping plots')
+        return
+
+    for axis in dict.fromkeys(row['axis'] for row in rows):
+        fig, (ax_time, ax_memory) = plt.subplots(1, 2, figsize=(10, 4))
+        for model in dict.fromkeys(row['model'] for row in rows):
+            points = [row for row in rows if row['axis'] == axis and row['model'] == model
+                      and row['status'] == 'ok']
+            values = [row['value'] for row in points]
+            memory_key = 'peak_cuda_mb' if points and points[0]['peak_cuda_mb'] is not None else 'peak_rss_mb'
+            ax_time.plot(values, [row['iteration_ms'] for row in points], marker='o', label=model)
+            ax_memory.plot(values, [row[memory_key] for row in points], marker='o', label=model)
+        for ax, label in [(ax_time, 'ms per iteration'), (ax_memory, 'peak memory (MB)')]:
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+            ax.set_xlabel(axis)
+            ax.set_ylabel(label)
+            ax.legend()
+        fig.tight_layout()
+        fig.savefig(os.path.join(args.scaling_output_dir, f'{axis}.png'))
+        plt.close(fig)
+
+
+def main(args, base_argv):
+    os.makedirs(args.scaling_output_dir, exist_ok=True)
+    points = sweep_points(args)
+    if len(points) == 0:
+        print('No scaling point to run.')
+        return
+    print(f'Running {len(points)} scaling points')
+
+    rows = []
+    for model, axis, value in points:
+        row = run_point(args, base_argv, model, axis, value)
+        print(f"{model:<10}{axis:<18}{value:>10}  {row['status']:<12}"
+              f"{row['iteration_ms'] or float('nan'):>12.2f} ms"
+              f"{row['peak_cuda_mb'] or row['peak_rss_mb'] or float('nan'):>12.1f} MB")
+        rows.append(row)
+
+    # scaling exponent of every curve
+    for model in dict.fromkeys(row['model'] for row in rows):
+        for axis in dict.fromkeys(row['axis'] for row in rows):
+            curve = [row for row in rows if row['model'] == model and row['axis'] == axis]
+            for row, slope in zip(curve, scaling_exponent(curve)):
+                row['time_exponent'] = slope
+
+    path = os.path.join(args.scaling_output_dir, 'scaling.csv')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Scaling curves saved to', path)
+    plot_curves(args, rows)
+
+
+if __name__ == '__main__':
+    main(parse_args(), sys.argv[1:])
@@ -0,0 +1,307 @@
+from inference import Predictor
+from options import parse_args
+
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+MAX_BODY_BYTES = 1 << 20
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ServerMetrics():
+    """
+        Request counters, queue depth, batch sizes and latencies of the server.
+        Batch sizes and latencies are kept for the last `window` batches / requests,
+        extra returns further metrics (e.g. of the adapted weights cache).
+    """
+
+    def __init__(self, window=1000, extra=None):
+        self.start = time.time()
+        self.extra = extra
+        self.counts = {'requests': 0, 'responses': 0, 'rejected': 0,
+                       'timeouts': 0, 'errors': 0, 'batches': 0}
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def record_queue_depth(self, depth):
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_batch(self, size):
+        self.counts['batches'] += 1
+        self.batch_sizes.append(size)
+
+    def record_latency(self, seconds):
+        self.counts['responses'] += 1
+        self.latencies.append(seconds * 1000)
+
+    def snapshot(self, queue_depth):
+        metrics = dict(self.counts)
+        metrics['uptime_s'] = time.time() - self.start
+        metrics['queue_depth'] = queue_depth
+        metrics['max_queue_depth'] = self.max_queue_depth
+        if self.batch_sizes:
+            metrics['batch_size_mean'] = float(np.mean(self.batch_sizes))
+            metrics['batch_size_max'] = int(np.max(self.batch_sizes))
+        if self.latencies:
+            for q in (50, 90, 99):
+                metrics[f'latency_p{q}_ms'] = float(
+                    np.percentile(self.latencies, q))
+        if self.extra is not None:
+            metrics.update(self.extra())
+        return metrics
+
+
+class BatchingQueue():
+    """
+        Coalesces concurrent prediction requests into one predict_batch call.
+
+        The first request of a batch waits at most `window_ms` for others to arrive
+        (up to max_batch_size), then the whole batch is handled by one call of
+        predict_batch in a single worker thread (MAML.adapt_batch, which shares the
+        autograd calls of the inner steps but still runs forwards per task), so the event loop keeps accepting
+        requests meanwhile and the model is never used by two threads.
+        Latency is bounded: a full queue rejects new requests (Overloaded) and a
+        request not answered within timeout_ms raises asyncio.TimeoutError, requests
+        that timed out before their batch starts are dropped from it.
+    """
+
+    def __init__(self, predict_batch, window_ms=5.0, max_batch_size=32, max_queue=1024,
+                 timeout_ms=1000.0, metrics=None):
+        self.predict_batch = predict_batch
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout_ms / 1000
+        self.metrics = metrics or ServerMetrics()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    async def submit(self, request):
+        '''
+            prediction of one request, waits for its batch
+        '''
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((request, future))
+        except asyncio.QueueFull:
+            self.metrics.counts['rejected'] += 1
+            raise Overloaded()
+        self.metrics.record_queue_depth(self.queue.qsize())
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.metrics.counts['timeouts'] += 1
+            raise
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # cancelled futures belong to requests that already timed out
+        return [(request, future) for request, future in batch if not future.done()]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            if len(batch) == 0:
+                continue
+            self.metrics.record_batch(len(batch))
+            requests = [request for request, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict_batch, requests)
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def parse_request(body):
+    '''
+        predict_batch request of a json body
+        {"user_id": 0, "history": [[item, rating], ...], "targets": [item, ...]}
+    '''
+    try:
+        payload = json.loads(body)
+        history = payload['history']
+        request = {
+            'user_id': int(payload.get('user_id', 0)),
+            'product_ids': [int(item) for item, _ in history],
+            'ratings': [float(rating) for _, rating in history],
+            'target_product_ids': [int(item) for item in payload['targets']],
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'invalid request: {e}')
+    if len(request['product_ids']) == 0 or len(request['target_product_ids']) == 0:
+        raise ValueError('history and targets must not be empty')
+    return request
+
+
+async def read_request(reader):
+    '''
+        (method, path, headers, body) of the next http request, None at end of stream
+    '''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise OverflowError()
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, path.split('?')[0], headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = (f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+
+
+async def handle(batcher, method, path, body):
+    '''
+        (status, payload) of one request
+        POST /predict, GET /metrics, GET /health
+    '''
+    if method == 'GET' and path == '/metrics':
+        return 200, batcher.metrics.snapshot(batcher.depth())
+    if method == 'GET' and path == '/health':
+        return 200, {'status': 'ok'}
+    if method != 'POST' or path != '/predict':
+        return 404, {'error': f'{method} {path} not found'}
+
+    start = time.perf_counter()
+    batcher.metrics.counts['requests'] += 1
+    try:
+        request = parse_request(body)
+        predictions = await batcher.submit(request)
+    except ValueError as e:
+        batcher.metrics.counts['errors'] += 1
+        return 400, {'error': str(e)}
+    except Overloaded:
+        return 503, {'error': 'too many pending requests'}
+    except asyncio.TimeoutError:
+        return 504, {'error': 'request timed out'}
+    except Exception as e:
+        batcher.metrics.counts['errors'] += 1
+        return 500, {'error': repr(e)}
+    batcher.metrics.record_latency(time.perf_counter() - start)
+    return 200, {'predictions': [float(rating) for rating in predictions]}
+
+
+async def serve_connection(batcher, reader, writer):
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except OverflowError:
+                write_response(writer, 413, {'error': 'request body too large'}, False)
+                break
+            except (ValueError, asyncio.IncompleteReadError):
+                write_response(writer, 400, {'error': 'malformed http request'}, False)
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            status, payload = await handle(batcher, method, path, body)
+            write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args, predict_batch, extra_metrics=None):
+    '''
+        run the batching server until cancelled
+
+        Args:
+            args : options with server_* settings
+            predict_batch : function of a list of requests returning a list of predictions
+            extra_metrics : function returning a dict added to /metrics
+    '''
+    batcher = BatchingQueue(predict_batch, window_ms=args.server_batch_window_ms,
+                            max_batch_size=args.server_max_batch_size,
+                            max_queue=args.server_max_queue, timeout_ms=args.server_timeout_ms,
+                            metrics=ServerMetrics(extra=extra_metrics))
+    worker = asyncio.ensure_future(batcher.run())
+
+    def on_connection(reader, writer):
+        return serve_connection(batcher, reader, writer)
+
+    if args.server_unix_socket is not None:
+        server = await asyncio.start_unix_server(on_connection, path=args.server_unix_socket)
+        print('Serving on', args.server_unix_socket)
+    else:
+        server = await asyncio.start_server(on_connection, host=args.server_host, port=args.server_port)
+        print(f'Serving on http://{args.server_host}:{args.server_port}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+        batcher.close()
+
+
+def main(args):
+    # the server has no authentication, so it never listens on public addresses
+    if args.server_unix_socket is None and args.server_host not in LOOPBACK_HOSTS:
+        raise ValueError(
+            f'--server_host must be a loopback address, got {args.server_host}')
+    predictor = Predictor(args, args.checkpoint_step, args.test_best)
+    try:
+        asyncio.run(serve(args, predictor.predict_batch, extra_metrics=lambda: {
+            f'cache_{name}': value for name, value in predictor.cache.summary().items()}))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,98 @@
+from dataloader import DataLoader
+from task_store import TaskStore, load_task_store
+from checkpoint import checkpoint_pattern, list_checkpoints
+from options import parse_args
+
+import torch
+import torch.multiprocessing as mp
+import csv
+import os
+
+# model and frozen test tasks of a worker process
+_maml = None
+_store = None
+
+
+def select_checkpoints(args, save_dir):
+    '''
+        (step, is_best) of checkpoints in save_dir selected by the sweep options
+        new (.ckpt) and legacy (.pt) checkpoints are both listed
+    '''
+    selected = set()
+    for ext in ['.ckpt', '.pt']:
+        pattern = checkpoint_pattern(
+            f"{args.model}_", f"_{args.mode}_{args.model}{ext}")
+        for step, best, _ in list_checkpoints(save_dir, pattern):
+            if args.sweep_start > -1 and step < args.sweep_start:
+                continue
+            if args.sweep_end > -1 and step > args.sweep_end:
+                continue
+            if args.sweep_checkpoints == 'best' and not best:
+                continue
+            if args.sweep_checkpoints == 'regular' and best:
+                continue
+            selected.add((step, best))
+    return sorted(selected)
+
+
+def init_worker(args, store_path, num_threads):
+    '''
+        build one evaluation model per worker (no optimizers, checkpoint writer or metrics),
+        checkpoints are loaded into it one after another
+    '''
+    from main import MAML
+
+    global _maml, _store
+    torch.set_num_threads(num_threads)
+    _maml = MAML(args, load_data=False, training=False)
+    _store = TaskStore(store_path)
+
+
+def evaluate_checkpoint(checkpoint):
+    step, best = checkpoint
+    _maml.load(step, best, training=False)
+    _maml.reset_rating_info()
+    mse_loss, rmse_loss, mae_loss = _maml.evaluate(
+        _store.iter_batches(_maml.batch_size))
+    return step, best, mse_loss, rmse_loss, mae_loss
+
+
+def main(args):
+    save_dir = os.path.join(args.log_dir, 'state')
+    checkpoints = select_checkpoints(args, save_dir)
+    if len(checkpoints) == 0:
+        print(f'No checkpoint to evaluate in {save_dir}.')
+        return
+
+    # preprocess once and freeze the test tasks shared by every worker
+    dataloader = DataLoader(args, pretraining=False)
+    args.num_users = dataloader.num_users
+    args.num_items = dataloader.num_items
+    store = load_task_store(dataloader, args, "test", args.num_test_data,
+                            normalized=args.normalize_loss, use_label=args.use_label)
+    del dataloader
+
+    num_workers = max(1, min(args.sweep_num_workers, len(checkpoints)))
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    print(f'Evaluating {len(checkpoints)} checkpoints with {num_workers} workers')
+
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(num_workers, initializer=init_worker, initargs=(args, store.path, num_threads)) as pool:
+        results = pool.map(evaluate_checkpoint, checkpoints, chunksize=1)
+
+    print(f"{'step':>8} {'best':>5} {'MSE':>8} {'RMSE':>8} {'MAE':>8}")
+    for step, best, mse_loss, rmse_loss, mae_loss in results:
+        print(f'{step:>8} {str(best):>5} {mse_loss:>8.4f} {rmse_loss:>8.4f} {mae_loss:>8.4f}')
+    step, best, _, rmse_loss, _ = min(results, key=lambda result: result[3])
+    print(f'Best checkpoint: step {step} (best: {best}) | RMSE loss: {rmse_loss:.4f}')
+
+    if args.sweep_output is not None:
+        with open(args.sweep_output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['step', 'best', 'mse', 'rmse', 'mae'])
+            writer.writerows(results)
+        print('Results saved to', args.sweep_output)
+
+
+if __name__ == '__main__':
+    main(parse_args())
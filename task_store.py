@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+
+class TaskStoreWriter():
+    """
+        Appends tasks generated by DataLoader.generate_task to raw binary files.
+        Support and query rows of all tasks are concatenated, task boundaries are
+        kept as offsets. meta.json records dtypes and shapes so that the files can
+        be memory-mapped by TaskStore.
+    """
+
+    FIELDS = {
+        'support_products': np.int32,
+        'support_ratings': np.float32,
+        'query_products': np.int32,
+        'query_ratings': np.float32,
+        'task_info': np.float32,
+    }
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.files = {name: open(os.path.join(self.path, f"{name}.bin"), 'wb')
+                      for name in self.FIELDS}
+        self.user_ids = []
+        self.support_offsets = [0]
+        self.query_offsets = [0]
+        self.seq_len = None
+        self.task_info_dim = None
+
+    def write(self, name, tensor):
+        array = np.ascontiguousarray(
+            tensor.detach().cpu().numpy(), dtype=self.FIELDS[name])
+        self.files[name].write(array.tobytes())
+
+    def add(self, task):
+        '''
+            append a single (support_set, query_set, task_info) task
+        '''
+        support, query, task_info = task
+        support_user_id, support_history, support_target, support_rating_history, support_target_rating = support
+        _, query_history, query_target, query_rating_history, query_target_rating = query
+
+        self.write('support_products', torch.cat(
+            (support_history, support_target), dim=1))
+        self.write('support_ratings', torch.cat(
+            (support_rating_history, support_target_rating), dim=1))
+        self.write('query_products', torch.cat(
+            (query_history, query_target), dim=1))
+        self.write('query_ratings', torch.cat(
+            (query_rating_history, query_target_rating), dim=1))
+
+        # task information can be empty when every task_info option is off
+        if torch.is_tensor(task_info):
+            self.write('task_info', task_info)
+            self.task_info_dim = task_info.size(2)
+
+        self.seq_len = support_history.size(1) + 1
+        self.user_ids.append(int(support_user_id[0, 0]))
+        self.support_offsets.append(
+            self.support_offsets[-1] + len(support_history))
+        self.query_offsets.append(self.query_offsets[-1] + len(query_history))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        np.save(os.path.join(self.path, 'user_ids.npy'),
+                np.asarray(self.user_ids, dtype=np.int64))
+        np.save(os.path.join(self.path, 'support_offsets.npy'),
+                np.asarray(self.support_offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, 'query_offsets.npy'),
+                np.asarray(self.query_offsets, dtype=np.int64))
+        meta = {
+            'num_tasks': len(self.user_ids),
+            'seq_len': self.seq_len,
+            'num_support': self.support_offsets[-1],
+            'num_query': self.query_offsets[-1],
+            'task_info_dim': self.task_info_dim,
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class TaskStore():
+    """
+        Frozen validation/test tasks read back from memory-mapped files.
+        Indexing with an integer returns a task, indexing with a slice returns a
+        list of tasks, so a store can be used wherever a list of tasks is used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.user_ids = np.load(os.path.join(path, 'user_ids.npy'))
+        self.support_offsets = np.load(
+            os.path.join(path, 'support_offsets.npy'))
+        self.query_offsets = np.load(os.path.join(path, 'query_offsets.npy'))
+
+        seq_len = self.meta['seq_len']
+        num_support = self.meta['num_support']
+        num_query = self.meta['num_query']
+        self.support_products = self.memmap(
+            'support_products', (num_support, seq_len))
+        self.support_ratings = self.memmap(
+            'support_ratings', (num_support, seq_len))
+        self.query_products = self.memmap(
+            'query_products', (num_query, seq_len))
+        self.query_ratings = self.memmap('query_ratings', (num_query, seq_len))
+        if self.meta['task_info_dim'] is not None:
+            self.task_info = self.memmap(
+                'task_info', (num_support, seq_len, self.meta['task_info_dim']))
+        else:
+            self.task_info = None
+
+    def memmap(self, name, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=TaskStoreWriter.FIELDS[name])
+        return np.memmap(os.path.join(self.path, f"{name}.bin"),
+                         dtype=TaskStoreWriter.FIELDS[name], mode='r', shape=shape)
+
+    def __len__(self):
+        return self.meta['num_tasks']
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.get_task(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('task index out of range')
+        return self.get_task(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.get_task(idx)
+
+    def iter_batches(self, batch_size):
+        '''
+            yield lists of batch_size tasks
+        '''
+        for start in range(0, len(self), batch_size):
+            yield self[start:start+batch_size]
+
+    def split_rows(self, user_id, products, ratings):
+        products = torch.from_numpy(np.array(products)).long()
+        ratings = torch.from_numpy(np.array(ratings))
+        user_id = user_id.repeat(len(products), 1)
+        return (user_id, products[:, :-1], products[:, -1:], ratings[:, :-1], ratings[:, -1:])
+
+    def get_task(self, idx):
+        '''
+            rebuild (support_set, query_set, task_info) of task idx
+        '''
+        user_id = torch.tensor(int(self.user_ids[idx]))
+        s_start, s_end = self.support_offsets[idx], self.support_offsets[idx+1]
+        q_start, q_end = self.query_offsets[idx], self.query_offsets[idx+1]
+
+        support_data = self.split_rows(
+            user_id, self.support_products[s_start:s_end], self.support_ratings[s_start:s_end])
+        query_data = self.split_rows(
+            user_id, self.query_products[q_start:q_end], self.query_ratings[q_start:q_end])
+        if self.task_info is not None:
+            task_info = torch.from_numpy(
+                np.array(self.task_info[s_start:s_end]))
+        else:
+            task_info = []
+        return support_data, query_data, task_info
+
+
+def task_store_path(args, mode, num_tasks, normalized, use_label):
+    '''
+        directory of the frozen task store for the given dataset, seed and task options
+    '''
+    config = {
+        'data_path': os.path.abspath(args.data_path),
+        'data_size': os.path.getsize(args.data_path) if os.path.isfile(args.data_path) else None,
+        'mode': args.mode,
+        'split': mode,
+        'num_tasks': num_tasks,
+        'random_seed': args.random_seed,
+        'num_test_data': args.num_test_data,
+        'min_sequence': args.min_sequence,
+        'min_item': args.min_item,
+        'kcore_max_iter': args.kcore_max_iter,
+        'max_seq_len': args.max_seq_len,
+        'min_sub_window_size': args.min_sub_window_size,
+        'num_samples': args.num_samples,
+        'num_query_set': args.num_query_set,
+        'default_rating': args.default_rating,
+        'use_random_sequence_length': args.use_random_sequence_length,
+        'task_info_rating_mean': args.task_info_rating_mean,
+        'task_info_rating_std': args.task_info_rating_std,
+        'task_info_labels': args.task_info_labels,
+        'normalized': normalized,
+        'use_label': use_label,
+    }
+    if args.mode == 'synthetic':
+        config.update({name: value for name, value in vars(args).items()
+                       if name.startswith('synthetic_')})
+    key = hashlib.md5(json.dumps(
+        config, sort_keys=True).encode()).hexdigest()[:12]
+    return os.path.join(args.task_store_dir, f"{args.mode}_{mode}_{args.random_seed}_{key}")
+
+
+def load_task_store(dataloader, args, mode, num_tasks, normalized=False, use_label=True):
+    '''
+    load frozen tasks of valid or test split, generating them on first use
+    tasks are generated with random_seed so that every launch evaluates the same tasks
+
+    Args:
+        dataloader : DataLoader used to generate tasks
+        mode : valid or test
+        num_tasks : the number of tasks
+        normalized : use normalized version of ratings
+    return:
+        store : TaskStore
+    '''
+    path = task_store_path(args, mode, num_tasks, normalized, use_label)
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        print("Loading frozen tasks from", path)
+        return TaskStore(path)
+
+    print("Generating frozen tasks to", path)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # generate chunk by chunk with a fixed seed
+    writer = TaskStoreWriter(tmp_path)
+    for tasks in dataloader.iter_tasks(mode=mode, num_tasks=num_tasks, batch_size=args.batch_size,
+                                       normalized=normalized, use_label=use_label, seed=args.random_seed):
+        for task in tasks:
+            writer.add(task)
+    writer.close()
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return TaskStore(path)
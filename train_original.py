@@ -1,14 +1,19 @@
 from models import model_factory
-from dataloader import DataLoader
-from options import args
-import wandb
+from dataloader import DataLoader, padding_start
+from checkpoint import save_tensor_blob
+from metrics import MetricsSink, make_metrics_sink
+from options import parse_args
 
 from models.meta_loss_model import MetaTaskLstmNetwork
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import os
+import time
 import numpy as np
 # from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
@@ -18,26 +23,55 @@ VAL_INTERVAL = 1
 
 
 class Basic:
-    def __init__(self, args):
+    def __init__(self, args, dataloader=None, rank=0, world_size=1):
+        '''
+        Args:
+            dataloader : preprocessed DataLoader shared by data parallel processes
+            rank : rank of this process for data parallel pretraining
+            world_size : number of data parallel processes (1 : single process)
+        '''
+
+        # sasrec has no key padding mask and attends over padding, trimming it would change the model
+        if args.trim_padding and args.model == 'sasrec':
+            raise ValueError('trim_padding can not be used with sasrec')
 
         # load dataloaders
         self.args = args
         self.batch_size = args.batch_size
-        self.dataloader = DataLoader(args, pretraining=True)
-        self.pretraining_train_loader = self.dataloader.pretraining_train_loader
-        self.pretraining_valid_loader = self.dataloader.pretraining_valid_loader
-        self.pretraining_test_loader = self.dataloader.pretraining_test_loader
+        self.rank = rank
+        self.world_size = world_size
+        if world_size > 1:
+            # each process reads its own shard of every epoch
+            self.dataloader = dataloader
+            batch_size = max(1, args.pretraining_batch_size // world_size)
+            self.pretraining_train_loader = self.dataloader.make_pretraining_dataloader(
+                self.dataloader.train_set, batch_size, rank=rank, world_size=world_size)
+            self.pretraining_valid_loader = self.dataloader.make_pretraining_dataloader(
+                self.dataloader.valid_set, batch_size, rank=rank, world_size=world_size)
+            self.pretraining_test_loader = self.dataloader.make_pretraining_dataloader(
+                self.dataloader.test_set, batch_size, num_queries=args.num_query_set, rank=rank, world_size=world_size)
+        else:
+            self.dataloader = DataLoader(args, pretraining=True)
+            self.pretraining_train_loader = self.dataloader.pretraining_train_loader
+            self.pretraining_valid_loader = self.dataloader.pretraining_valid_loader
+            self.pretraining_test_loader = self.dataloader.pretraining_test_loader
         self.args.num_users = self.dataloader.num_users
         self.args.num_items = self.dataloader.num_items
 
         # device settings
         self.device = torch.device('cpu')
         if torch.cuda.is_available():
+            torch.cuda.set_device(rank % torch.cuda.device_count())
             self.device = torch.cuda.current_device()
         self.args.device = self.device
         # get basic model
         self.model = model_factory(self.args).to(self.device)
 
+        # data parallel wrapper (gradients are averaged over processes)
+        self.train_model = self.model
+        if world_size > 1:
+            self.train_model = self.wrap_distributed(self.model)
+
         # set logging and saving folders
         self._log_dir = args.pretrain_log_dir
         self._save_dir = os.path.join(args.pretrain_log_dir, 'state')
@@ -49,6 +83,12 @@ class Basic:
         os.makedirs(self._embedding_dir, exist_ok=True)
         os.makedirs(self._pretrained_dir, exist_ok=True)
 
+        # only the main process logs metrics
+        if rank == 0:
+            self.metrics = make_metrics_sink(args, self._log_dir)
+        else:
+            self.metrics = MetricsSink()
+
         # hyperparamters and optimizers
         self._lr = args.pretraining_lr
         self.optimizer = optim.Adam(self.model.parameters(), lr=self._lr)
@@ -69,6 +109,10 @@ class Basic:
                 self.task_lstm_network.parameters(), lr=self._lstm_lr)
             self.lstm_lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(
                 self.task_lstm_optimizer, T_max=args.pretrain_epochs, eta_min=1e-2)
+            self.train_task_lstm_network = self.task_lstm_network
+            if world_size > 1:
+                self.train_task_lstm_network = self.wrap_distributed(
+                    self.task_lstm_network)
 
         self.best_valid_rmse_loss = 987654321
         self.best_step = 0
@@ -85,6 +129,24 @@ class Basic:
 
         self._train_step = 0
 
+    def wrap_distributed(self, module):
+        '''
+            wrap module with DistributedDataParallel
+        '''
+        if torch.cuda.is_available():
+            return DistributedDataParallel(module, device_ids=[self.device])
+        return DistributedDataParallel(module)
+
+    def reduce_mean(self, values):
+        '''
+            mean of per batch values over all data parallel processes
+        '''
+        if self.world_size == 1:
+            return np.mean(values)
+        totals = torch.tensor([np.sum(values), len(values)], dtype=torch.float64)
+        dist.all_reduce(totals)
+        return (totals[0] / totals[1]).item()
+
     def eval_by_rating(self, output, target_rating, loss_fn):
         with torch.no_grad():
             for i in range(1,6):
@@ -115,7 +177,7 @@ class Basic:
         else:
             self.model.eval()
         # one epoch opeartion
-        for input, target_rating in tqdm(data_loader):
+        for input, target_rating in tqdm(data_loader, disable=self.rank != 0):
             user_id, product_history, target_product_id,  product_history_ratings = input
 
             B, S, T = product_history.shape
@@ -125,6 +187,12 @@ class Basic:
             product_history_ratings = product_history_ratings.view(-1, T)
             target_rating = target_rating.view(-1, 1)
 
+            # trim columns that are padding in every sequence of the batch
+            if self.args.trim_padding:
+                start = padding_start(product_history)
+                product_history = product_history[:, start:]
+                product_history_ratings = product_history_ratings[:, start:]
+
             # gpu loading
             x_inputs = (user_id.to(self.device), product_history.to(
                 self.device),
@@ -136,7 +204,9 @@ class Basic:
                 self.task_lstm_optimizer.zero_grad()
 
             # forward prop
-            outputs = self.model(
+            # evaluation does not need gradient synchronization
+            model = self.train_model if train else self.model
+            outputs = model(
                 x_inputs)
             gt = torch.cat(
                 (x_inputs[3], target_rating), dim=1)
@@ -148,7 +218,8 @@ class Basic:
                 if self.use_lstm:
                     task_input = torch.cat(
                         (x_inputs[3], target_rating), dim=1)
-                    task_info = self.task_lstm_network(
+                    task_lstm_network = self.train_task_lstm_network if train else self.task_lstm_network
+                    task_info = task_lstm_network(
                         task_input).squeeze()
                     adapt_loss = loss * task_info * mask
                     loss = adapt_loss.sum()/torch.count_nonzero(adapt_loss)
@@ -168,7 +239,8 @@ class Basic:
                 if self.use_lstm:
                     task_input = torch.cat(
                         (x_inputs[3], target_rating), dim=1)
-                    task_info = self.task_lstm_network(
+                    task_lstm_network = self.train_task_lstm_network if train else self.task_lstm_network
+                    task_info = task_lstm_network(
                         task_input).squeeze()
                     adapt_loss = loss * task_info * mask
                     loss = adapt_loss.sum()/torch.count_nonzero(adapt_loss)
@@ -197,9 +269,9 @@ class Basic:
             rmse_losses.append(rmse_loss.item())
 
         # set results
-        mae_loss = np.mean(mae_losses)
-        mse_loss = np.mean(mse_losses)
-        rmse_loss = np.mean(rmse_losses)
+        mae_loss = self.reduce_mean(mae_losses)
+        mse_loss = self.reduce_mean(mse_losses)
+        rmse_loss = self.reduce_mean(rmse_losses)
 
         return mse_loss, mae_loss, rmse_loss
 
@@ -213,53 +285,78 @@ class Basic:
         Args:
             train_steps (int) : the number of steps this model should train for
         """
-        print(f"Starting Basic model training at iteration {self._train_step}")
+        is_main = self.rank == 0
+        if is_main:
+            print(f"Starting Basic model training at iteration {self._train_step}")
 
-        # initialize wandb project
-        wandb.init(project=f"BASE-TRAIN-{self.args.model}-{self.args.mode}")
-
-        # define tensorboard writer and wandb config
-        # writer = SummaryWriter(log_dir=self._log_dir)
-        wandb.config.update(self.args)
+            # initialize metrics run
+            self.metrics.init(
+                f"BASE-TRAIN-{self.args.model}-{self.args.mode}", self.args)
 
         for epoch in range(epochs):
+            # reshuffle shards of data parallel processes
+            if self.world_size > 1:
+                self.pretraining_train_loader.sampler.sampler.set_epoch(epoch)
+
+            epoch_start = time.perf_counter()
             mse_loss, mae_loss, rmse_loss = self.epoch_step(
                 self.pretraining_train_loader)
+            epoch_time = time.perf_counter() - epoch_start
 
-            if self._train_step % LOG_INTERVAL == 0:
+            if self._train_step % LOG_INTERVAL == 0 and is_main:
                 print(
                     f'Epoch {self._train_step}: '
                     f'MSE loss: {mse_loss:.4f} | '
                     f'RMSE loss: {rmse_loss:.4f} | '
                     f'MAE loss: {mae_loss:.4f} | '
                 )
+                self.metrics.log({
+                    "train/mse_loss": mse_loss,
+                    "train/rmse_loss": rmse_loss,
+                    "train/mae_loss": mae_loss,
+                    "train/batches_per_s": len(self.pretraining_train_loader) / epoch_time,
+                    "train/epoch_ms": epoch_time * 1000,
+                }, step=self._train_step)
                 # writer.add_scalar(
                 #     "train/MSEloss", mse_loss, self._train_step)
                 # writer.add_scalar(
                 #     "train/MAEloss", mae_loss, self._train_step)
 
             if epoch % VAL_INTERVAL == 0:
+                valid_start = time.perf_counter()
                 mse_loss, mae_loss, rmse_loss = self.epoch_step(
                     self.pretraining_valid_loader, train=False)
+                valid_time = time.perf_counter() - valid_start
 
-                print(
-                    f'\tValidation: '
-                    f'Val MSE loss: {mse_loss:.4f} | '
-                    f'Val RMSE loss: {rmse_loss:.4f} | '
-                    f'Val MAE loss: {mae_loss:.4f} | '
-                )
-                wandb.log({"loss": rmse_loss})
+                if is_main:
+                    print(
+                        f'\tValidation: '
+                        f'Val MSE loss: {mse_loss:.4f} | '
+                        f'Val RMSE loss: {rmse_loss:.4f} | '
+                        f'Val MAE loss: {mae_loss:.4f} | '
+                    )
+                    self.metrics.log({
+                        "loss": rmse_loss,
+                        "valid/mse_loss": mse_loss,
+                        "valid/mae_loss": mae_loss,
+                        "valid/ms": valid_time * 1000,
+                    }, step=self._train_step)
 
                 # Save the best model wrt valid rmse loss
+                # (validation losses are reduced, so every process agrees)
                 if self.best_valid_rmse_loss > rmse_loss:
                     self.best_valid_rmse_loss = rmse_loss
                     self.best_step = epoch
-                    self._save_model()
-                    print(
-                        f'........Model saved (step: {self.best_step} | RMSE loss: {rmse_loss:.4f})')
+                    if is_main:
+                        self._save_model()
+                        print(
+                            f'........Model saved (step: {self.best_step} | RMSE loss: {rmse_loss:.4f})')
 
             self._train_step += 1
         # writer.close()
+        if not is_main:
+            return
+        self.metrics.close()
         print("-------------------------------------------------")
         print("Model with the best validation RMSE loss is saved.")
         print(f'Best step: {self.best_step}')
@@ -294,15 +391,15 @@ class Basic:
         '''
         if self.args.save_pretrained:
             if self.args.model == 'sasrec' or self.args.model == 'bert4rec':
-                torch.save(self.model.bert.bert_embedding.state_dict(),
-                           os.path.join(self._embedding_dir, f"{self.args.model}_embedding_{self.args.mode}_{self.args.bert_hidden_units}_{self.args.bert_num_blocks}_{self.args.bert_num_heads}"))
+                save_tensor_blob(os.path.join(self._embedding_dir, f"{self.args.model}_embedding_{self.args.mode}_{self.args.bert_hidden_units}_{self.args.bert_num_blocks}_{self.args.bert_num_heads}"),
+                                 self.model.bert.bert_embedding.state_dict())
             else:
-                torch.save(self.model.embedding.state_dict(),
-                           os.path.join(self._embedding_dir, f"{self.args.model}_embedding_{self.args.mode}"))
+                save_tensor_blob(os.path.join(self._embedding_dir, f"{self.args.model}_embedding_{self.args.mode}"),
+                                 self.model.embedding.state_dict())
 
             # Save a model to 'pretrained_dir'
-            torch.save(self.model.state_dict(),
-                       os.path.join(self._pretrained_dir, f"{self.args.model}_pretrained_{self.args.mode}_{self.args.bert_hidden_units}_{self.args.bert_num_blocks}_{self.args.bert_num_heads}"))
+            save_tensor_blob(os.path.join(self._pretrained_dir, f"{self.args.model}_pretrained_{self.args.mode}_{self.args.bert_hidden_units}_{self.args.bert_num_blocks}_{self.args.bert_num_heads}"),
+                             self.model.state_dict())
         else:
             # Save a model to 'save_dir'
             torch.save(self.model.state_dict(),
@@ -313,14 +410,14 @@ class Basic:
             test on basic models
         '''
 
-        # initialize wandb project
-        wandb.init(project=f"BASE-TEST-{self.args.model}-{self.args.mode}")
-
-        # define wandb config
-        wandb.config.update(self.args)
+        # initialize metrics run
+        self.metrics.init(
+            f"BASE-TEST-{self.args.model}-{self.args.mode}", self.args)
 
+        test_start = time.perf_counter()
         mse_loss, mae_loss, rmse_loss = self.epoch_step(
             self.pretraining_test_loader, train=False)
+        test_time = time.perf_counter() - test_start
 
         print(
             f'\tTest: '
@@ -335,13 +432,41 @@ class Basic:
             print('Prediction Mean', np.mean((v['pred'])))
             print('Prediction Median', np.median((v['pred'])))
             print('Prediction Std', np.std((v['pred'])))
-        wandb.log({
+        self.metrics.log({
             "Test RMSE loss": rmse_loss,
-            "Test MAE loss": mae_loss
+            "Test MAE loss": mae_loss,
+            "test/batches_per_s": len(self.pretraining_test_loader) / test_time,
+            "test/ms": test_time * 1000,
         })
+        self.metrics.close()
+
+
+def run_distributed(rank, args, dataloader):
+    '''
+        data parallel pretraining process
+    '''
+    world_size = args.pretrain_world_size
+    dist.init_process_group('gloo', init_method=args.dist_url,
+                            rank=rank, world_size=world_size)
+    # share cores between processes
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+    basic_model = Basic(args, dataloader, rank, world_size)
+    if args.checkpoint_step > -1:
+        basic_model._train_step = args.checkpoint_step
+        basic_model.load(args.checkpoint_step)
+    basic_model.train(epochs=args.pretrain_epochs)
+    dist.destroy_process_group()
 
 
 def main(args):
+    if args.pretrain_world_size > 1 and not args.test:
+        # preprocess once and share the data with every process
+        dataloader = DataLoader(args, pretraining=False)
+        mp.spawn(run_distributed, args=(args, dataloader),
+                 nprocs=args.pretrain_world_size)
+        return
+
     basic_model = Basic(args)
 
     if args.checkpoint_step > -1:
@@ -357,4 +482,4 @@ def main(args):
 
 
 if __name__ == '__main__':
-    main(args)
+    main(parse_args())
@@ -0,0 +1,162 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def history_fingerprint(user_id, product_ids, ratings):
+    '''
+        hash of a user's rated history, key of the adapted weights cache
+    '''
+    digest = hashlib.sha1()
+    digest.update(np.asarray(product_ids, dtype=np.int64).tobytes())
+    digest.update(np.asarray(ratings, dtype=np.float32).tobytes())
+    return (int(user_id), digest.hexdigest())
+
+
+class WeightDelta():
+    """
+        Adapted fast weights stored as differences from the meta parameters.
+
+        The inner loop is plain gradient descent, so rows of the embedding that the
+        support set never looked up keep their meta value exactly. For each weight:
+        - 'sparse' : indices and values of changed rows (2d weights where at most
+                     sparse_ratio of the rows changed, e.g. item embeddings)
+        - 'lowrank': rank-r factors of the difference (2d weights, only with rank > 0
+                     and when the factors are smaller, approximate)
+        - 'dense'  : the full difference (small layers)
+        - None     : unchanged
+    """
+
+    def __init__(self, meta_weights, adapted_weights, rank=0, sparse_ratio=0.5, num_updates=0):
+        # incremental updates since the last adaptation from the meta parameters
+        self.num_updates = num_updates
+        self.entries = OrderedDict()
+        for name, adapted in adapted_weights.items():
+            meta = meta_weights[name].detach()
+            delta = adapted.detach() - meta
+            self.entries[name] = self.encode(delta, rank, sparse_ratio)
+
+    @staticmethod
+    def encode(delta, rank, sparse_ratio):
+        if delta.dim() == 2:
+            changed = delta.ne(0).any(dim=1).nonzero().view(-1)
+            if len(changed) == 0:
+                return None
+            if len(changed) <= sparse_ratio * delta.size(0):
+                return ('sparse', changed, delta[changed].clone())
+            rows, cols = delta.shape
+            if 0 < rank and rank * (rows + cols) < rows * cols:
+                U, S, V = torch.svd_lowrank(delta, q=rank)
+                return ('lowrank', U * S, V.t().contiguous())
+        elif not delta.ne(0).any():
+            return None
+        return ('dense', delta)
+
+    def decode(self, meta_weights):
+        '''
+            adapted weights of this delta applied to meta_weights
+        '''
+        weights = OrderedDict()
+        for name, entry in self.entries.items():
+            meta = meta_weights[name].detach()
+            if entry is None:
+                weights[name] = meta
+            elif entry[0] == 'sparse':
+                _, rows, values = entry
+                weights[name] = meta.index_add(0, rows, values)
+            elif entry[0] == 'lowrank':
+                _, left, right = entry
+                weights[name] = meta + left @ right
+            else:
+                weights[name] = meta + entry[1]
+        return weights
+
+    def nbytes(self):
+        size = 0
+        for entry in self.entries.values():
+            if entry is not None:
+                size += sum(tensor.numel() * tensor.element_size()
+                            for tensor in entry[1:])
+        return size
+
+
+class AdaptedWeightsCache():
+    """
+        LRU cache of adapted fast weights, keyed by history_fingerprint.
+
+        Entries are WeightDelta from the meta parameters of the checkpoint version
+        given to validate; a new version (a rewritten or different checkpoint)
+        clears the cache since the deltas no longer apply. The least recently used
+        entries are evicted beyond max_entries or max_bytes.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=256 * 1024 ** 2, rank=0, sparse_ratio=0.5):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.rank = rank
+        self.sparse_ratio = sparse_ratio
+        self.entries = OrderedDict()
+        self.version = None
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'misses': 0,
+                      'evictions': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def validate(self, version):
+        '''
+            clear the cache when the meta checkpoint version changed
+        '''
+        if version != self.version:
+            if len(self.entries) > 0:
+                self.stats['invalidations'] += 1
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key, meta_weights):
+        '''
+            adapted weights of key, None when not cached
+        '''
+        delta = self.entries.get(key)
+        if delta is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.entries.move_to_end(key)
+        return delta.decode(meta_weights)
+
+    def num_updates(self, key):
+        '''
+            incremental updates of the cached weights of key, None when not cached
+        '''
+        delta = self.entries.get(key)
+        return None if delta is None else delta.num_updates
+
+    def put(self, key, meta_weights, adapted_weights, num_updates=0):
+        if self.max_entries <= 0:
+            return
+        self.remove(key)
+        delta = WeightDelta(meta_weights, adapted_weights,
+                            self.rank, self.sparse_ratio, num_updates)
+        self.entries[key] = delta
+        self.nbytes += delta.nbytes()
+        while len(self.entries) > self.max_entries or \
+                (self.nbytes > self.max_bytes and len(self.entries) > 1):
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes()
+            self.stats['evictions'] += 1
+
+    def remove(self, key):
+        delta = self.entries.pop(key, None)
+        if delta is not None:
+            self.nbytes -= delta.nbytes()
+
+    def summary(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes, **self.stats}